@@ -0,0 +1,89 @@
+"""
+Micro-benchmark for :meth:`SQLAlchemyResource.format_many`.
+
+Compares the compiled formatter against formatting each entity by iterating over the fields of the model message and
+resolving the related resource for every relationship field, which is how entities were formatted before.
+
+Usage::
+
+    python -m benchmarks.format [rows] [repeat]
+
+"""
+import sys
+from timeit import repeat
+
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from venom import Message
+from venom.fields import Int32, String
+from venom.message import fields
+
+from venom_resource import SQLAlchemyResource, Relationship
+
+
+def format_by_reflection(resource: SQLAlchemyResource, entity):
+    message = resource.model_message()
+    for field in fields(resource.model_message):
+        if field.name in resource._relationships:
+            relationship = resource._relationships[field.name]
+            resource.resolve(relationship.resource)  # registry lookup per field and row
+            related_id = getattr(entity, field.name)
+            if related_id is not None:
+                message[field.name] = related_id
+        else:
+            message[field.name] = getattr(entity, field.name)
+    return message
+
+
+def main(rows: int = 1000, number: int = 20):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    sa = SQLAlchemy(app)
+
+    class Person(sa.Model):
+        id = sa.Column(sa.Integer(), primary_key=True)
+        name = sa.Column(sa.String())
+
+    class Pet(sa.Model):
+        id = sa.Column(sa.Integer(), primary_key=True)
+        name = sa.Column(sa.String())
+        species = sa.Column(sa.String())
+        age = sa.Column(sa.Integer())
+        owner_id = sa.Column(sa.Integer(), sa.ForeignKey(Person.id))
+        owner = sa.relationship(Person)
+
+    class PersonEntity(Message):
+        id = Int32()
+        name = String()
+
+    class PetEntity(Message):
+        id = Int32()
+        name = String()
+        species = String()
+        age = Int32()
+        owner_id = Int32()
+
+    with app.app_context():
+        sa.create_all()
+        people = SQLAlchemyResource(Person, PersonEntity, name='benchmark_people')
+        pets = SQLAlchemyResource(Pet, PetEntity, name='benchmark_pets', relationships={
+            Relationship(people, 'owner', 'owner_id')
+        })
+
+        sa.session.add_all(Person(id=i, name=f'person-{i}') for i in range(rows // 10))
+        sa.session.add_all(Pet(name=f'pet-{i}', species='snake', age=i % 20, owner_id=i % (rows // 10))
+                           for i in range(rows))
+        sa.session.commit()
+
+        entities = Pet.query.all()
+        assert pets.format_many(entities) == [format_by_reflection(pets, entity) for entity in entities]
+
+        for name, statement in (('reflection', lambda: [format_by_reflection(pets, entity) for entity in entities]),
+                                ('format_many', lambda: pets.format_many(entities))):
+            best = min(repeat(statement, number=number, repeat=5)) / number
+            print(f'{name:>12}: {best * 1000:8.3f} ms per {rows} rows')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,308 @@
+"""
+Benchmarks for the hot paths of :class:`SQLAlchemyResource`: ``create``, ``update``, ``get``, ``paginate`` and
+``format_many``.
+
+The benchmarks run on SQLite, either in memory or in a file, against synthetic tables of people and their pets. Pets
+are ordered by species, of which there are only a few, so that the ordering has many duplicates. Each benchmark reports
+its throughput, the number of queries per operation and the peak memory allocated while it runs.
+
+Usage::
+
+    python -m benchmarks.resource [--rows 10000] [--database memory|file] [--save] [--compare]
+
+With ``--save`` the results are stored as the baseline in ``benchmarks/baseline.json``, keyed by the database and the
+number of rows. With ``--compare`` they are compared to that baseline: a benchmark regresses if its throughput drops by
+more than ``--tolerance``, its peak memory grows by more than ``--tolerance`` or it runs more queries, and the script
+then exits with status 1.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterator, Tuple
+
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from venom import Message
+from venom.common import FieldMask
+from venom.fields import Int32, String
+
+from venom_resource import SQLAlchemyResource, Relationship
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+SPECIES = ('snake', 'cat', 'dog', 'parrot', 'hamster')
+PAGE_SIZE = 100
+INSERT_CHUNK_SIZE = 10000
+
+_Benchmark_T = Callable[['Environment'], Tuple[Callable[[], Any], int]]
+
+
+class Environment(object):
+    """
+    An application with the synthetic tables and their resources. ``rows`` pets belong to ``rows // 100`` people.
+    """
+
+    def __init__(self, rows: int, database_uri: str) -> None:
+        self.rows = rows
+        self.app = app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        self.sa = sa = SQLAlchemy(app)
+
+        class Person(sa.Model):
+            id = sa.Column(sa.Integer(), primary_key=True)
+            name = sa.Column(sa.String())
+
+        class Pet(sa.Model):
+            id = sa.Column(sa.Integer(), primary_key=True)
+            name = sa.Column(sa.String())
+            species = sa.Column(sa.String(), nullable=False, index=True)
+            age = sa.Column(sa.Integer())
+            owner_id = sa.Column(sa.Integer(), sa.ForeignKey(Person.id))
+            owner = sa.relationship(Person)
+
+        class PersonEntity(Message):
+            id = Int32()
+            name = String()
+
+        class PetEntity(Message):
+            id = Int32()
+            name = String()
+            species = String()
+            age = Int32()
+            owner_id = Int32()
+
+        self.Person, self.Pet, self.PetEntity = Person, Pet, PetEntity
+        self.people = SQLAlchemyResource(Person, PersonEntity, name='benchmark_people')
+        self.pets = SQLAlchemyResource(Pet, PetEntity, name='benchmark_pets', relationships={
+            Relationship(self.people, 'owner', 'owner_id')
+        })
+
+        self.queries = 0
+        event.listen(sa.engine, 'before_cursor_execute', self._count_query)
+
+    def _count_query(self, *args) -> None:
+        self.queries += 1
+
+    def populate(self) -> None:
+        sa, owners = self.sa, max(self.rows // 100, 1)
+
+        for start in range(0, owners, INSERT_CHUNK_SIZE):
+            sa.session.execute(self.Person.__table__.insert(), [
+                {'id': i + 1, 'name': f'person-{i}'} for i in range(start, min(start + INSERT_CHUNK_SIZE, owners))
+            ])
+
+        for start in range(0, self.rows, INSERT_CHUNK_SIZE):
+            sa.session.execute(self.Pet.__table__.insert(), [
+                {
+                    'id': i + 1,
+                    'name': f'pet-{i}',
+                    'species': SPECIES[i % len(SPECIES)],
+                    'age': i % 20,
+                    'owner_id': i % owners + 1
+                } for i in range(start, min(start + INSERT_CHUNK_SIZE, self.rows))
+            ])
+        sa.session.commit()
+
+    def ids(self) -> Iterator[int]:
+        # a fixed stride through the table, so that the runs are reproducible
+        i = 0
+        while True:
+            i = (i + 7919) % self.rows
+            yield i + 1
+
+
+def benchmark_create(env: Environment) -> Tuple[Callable[[], Any], int]:
+    owners = max(env.rows // 100, 1)
+    ids = env.ids()
+
+    def create():
+        i = next(ids)
+        env.pets.create_message(env.PetEntity(name=f'new-{i}', species=SPECIES[i % len(SPECIES)], age=1,
+                                              owner_id=i % owners + 1))
+    return create, 200
+
+
+def benchmark_update(env: Environment) -> Tuple[Callable[[], Any], int]:
+    ids = env.ids()
+    mask = FieldMask(['age'])
+
+    def update():
+        i = next(ids)
+        env.pets.update_by_id(i, env.PetEntity(age=i % 30), mask)
+    return update, 200
+
+
+def benchmark_get(env: Environment) -> Tuple[Callable[[], Any], int]:
+    ids = env.ids()
+    session = env.sa.session
+
+    def get():
+        # start from an empty identity map so that every lookup runs a query
+        session.expunge_all()
+        env.pets.get(next(ids))
+    return get, 1000
+
+
+def _benchmark_paginate(env: Environment, keyset: bool) -> Tuple[Callable[[], Any], int]:
+    pets = env.pets
+    pets.keyset_pagination = keyset
+    ordering = pets.parse_ordering(['species'])
+    token = ['']
+
+    def paginate():
+        result = pets.paginate(page_size=PAGE_SIZE, page_token=token[0], ordering=ordering)
+        token[0] = result['next_page_token'] or ''
+        pets.format_many(result['items'])
+    return paginate, 50
+
+
+def benchmark_paginate(env: Environment) -> Tuple[Callable[[], Any], int]:
+    return _benchmark_paginate(env, keyset=False)
+
+
+def benchmark_paginate_keyset(env: Environment) -> Tuple[Callable[[], Any], int]:
+    return _benchmark_paginate(env, keyset=True)
+
+
+def benchmark_format(env: Environment) -> Tuple[Callable[[], Any], int]:
+    entities = env.Pet.query.order_by(env.Pet.id).limit(1000).all()
+
+    def format_():
+        env.pets.format_many(entities)
+    return format_, 20
+
+
+BENCHMARKS: Dict[str, _Benchmark_T] = {
+    'create': benchmark_create,
+    'update': benchmark_update,
+    'get': benchmark_get,
+    'paginate': benchmark_paginate,
+    'paginate_keyset': benchmark_paginate_keyset,
+    'format': benchmark_format
+}
+
+
+def measure(env: Environment, benchmark: _Benchmark_T, repeat: int = 3) -> Dict[str, float]:
+    """
+    Returns the best throughput of ``repeat`` timed runs, followed by the queries per operation and peak memory of a
+    separate run with ``tracemalloc``, which would otherwise slow down the timed runs.
+    """
+    operation, number = benchmark(env)
+    operation()  # warm up caches, such as the compiled formatter
+
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        for _ in range(number):
+            operation()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    env.sa.session.expunge_all()
+    env.queries = 0
+    tracemalloc.start()
+    try:
+        for _ in range(number):
+            operation()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'ops_per_second': round(number / best, 1),
+        'queries_per_op': round(env.queries / number, 2),
+        'peak_memory_kib': round(peak / 1024, 1)
+    }
+
+
+def run(rows: int, database: str) -> Dict[str, Dict[str, float]]:
+    with tempfile.TemporaryDirectory() as directory:
+        if database == 'file':
+            database_uri = f'sqlite:///{os.path.join(directory, "benchmark.db")}'
+        else:
+            database_uri = 'sqlite://'
+
+        env = Environment(rows, database_uri)
+        with env.app.app_context():
+            env.sa.create_all()
+            env.populate()
+            results = {name: measure(env, benchmark) for name, benchmark in BENCHMARKS.items()}
+            env.sa.session.remove()
+            env.sa.engine.dispose()
+        return results
+
+
+def compare(results: Dict[str, Dict[str, float]],
+            baseline: Dict[str, Dict[str, float]],
+            tolerance: float) -> Dict[str, str]:
+    """
+    Returns a description of the regression of each benchmark that runs more queries than its baseline, or is slower
+    or uses more memory by more than ``tolerance``.
+    """
+    regressions = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        if result['queries_per_op'] > expected['queries_per_op']:
+            regressions[name] = f'{expected["queries_per_op"]} -> {result["queries_per_op"]} queries per operation'
+        elif result['ops_per_second'] < expected['ops_per_second'] * (1 - tolerance):
+            regressions[name] = f'{expected["ops_per_second"]} -> {result["ops_per_second"]} operations per second'
+        elif result['peak_memory_kib'] > expected['peak_memory_kib'] * (1 + tolerance):
+            regressions[name] = f'{expected["peak_memory_kib"]} -> {result["peak_memory_kib"]} KiB peak memory'
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths of SQLAlchemyResource.')
+    parser.add_argument('--rows', type=int, default=10000, help='number of pets, from 10000 to 1000000')
+    parser.add_argument('--database', choices=('memory', 'file'), default='memory')
+    parser.add_argument('--save', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--compare', action='store_true', help='compare the results with the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='the fraction by which throughput may drop or memory grow before it is a regression')
+    args = parser.parse_args(argv)
+
+    key = f'{args.database}-{args.rows}'
+    results = run(args.rows, args.database)
+
+    print(f'{key}:')
+    print(f'{"benchmark":>16} {"ops/s":>10} {"queries/op":>11} {"peak KiB":>10}')
+    for name, result in results.items():
+        print(f'{name:>16} {result["ops_per_second"]:>10} {result["queries_per_op"]:>11} '
+              f'{result["peak_memory_kib"]:>10}')
+
+    try:
+        with open(BASELINE_PATH) as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {}
+
+    status = 0
+    if args.compare:
+        if key not in baselines:
+            print(f'No baseline for {key}')
+            return 1
+
+        regressions = compare(results, baselines[key], args.tolerance)
+        for name, description in regressions.items():
+            print(f'Regression in {name}: {description}')
+        status = 1 if regressions else 0
+
+    if args.save:
+        baselines[key] = results
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
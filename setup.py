@@ -4,7 +4,7 @@ from setuptools import find_packages, setup
 setup(
     name='venom-resource',
     version='0.0.0',
-    packages=find_packages(exclude=['*tests*']),
+    packages=find_packages(exclude=['*tests*', 'benchmarks*']),
     license='MIT',
     author='Lars Schöning',
     author_email='lays@biosustain.dtu.dk',
@@ -1,16 +1,25 @@
+import asyncio
+import json
+import threading
+
 from flask_sqlalchemy import SQLAlchemy
 from flask_venom import Venom
 from flask_venom.test_utils import TestCase
+from sqlalchemy import event, bindparam
+from sqlalchemy.dialects import postgresql
 from venom import Message
 from venom.common import FieldMask
 from venom.common.types import JSONObject, JSONValue
-from venom.exceptions import NotFound
-from venom.fields import Integer, String, Field, RepeatField
+from venom.exceptions import NotFound, BadRequest, Conflict
+from venom.fields import Integer, String, Field, RepeatField, Bool
 from venom.message import fields, Empty
 from venom.rpc.test_utils import AioTestCaseMeta
 
-from venom_resource import SQLAlchemyResource
-from venom_resource.service import DynamicResourceService
+from venom_resource import SQLAlchemyResource, ThreadPoolResourceExecutor, LRUCache, HistogramCollector, Relationship
+from venom_resource.backends.alchemy.resource import _Explain
+from venom_resource.exceptions import NotModified
+from venom_resource.messages import BatchEntityError
+from venom_resource.service import DynamicResourceService, InstrumentationService
 
 
 class DynamicResourceServiceTestCase(TestCase, metaclass=AioTestCaseMeta):
@@ -24,7 +33,7 @@ class DynamicResourceServiceTestCase(TestCase, metaclass=AioTestCaseMeta):
     def _setup_pet_service_case(self):
         class Pet(self.sa.Model):
             id = self.sa.Column(self.sa.Integer(), primary_key=True)
-            name = self.sa.Column(self.sa.String(), nullable=True)
+            name = self.sa.Column(self.sa.String(), nullable=True, index=True)
 
         class PetMessage(Message):
             id = Integer()
@@ -55,6 +64,115 @@ class DynamicResourceServiceTestCase(TestCase, metaclass=AioTestCaseMeta):
             with self.assertRaises(NotFound):
                 await self.venom.get_instance(PetService).get(PetService.get.request(2))
 
+    async def test_e2e_get_entity_cache(self):
+        Pet, PetMessage, PetService = self._setup_pet_service_case()
+        PetService.__resource__.cache = cache = LRUCache(maxsize=2)
+
+        statements = []
+        event.listen(self.sa.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+        with self.app.app_context():
+            service = self.venom.get_instance(PetService)
+            for name in ('snek', 'noodle', 'fluff'):
+                PetService.__resource__.create(PetMessage(name=name))
+            self.sa.session.remove()
+
+            statements.clear()
+            self.assertEqual(await service.get(PetService.get.request(1)), PetMessage(1, 'snek'))
+            self.assertEqual(await service.get(PetService.get.request(1)), PetMessage(1, 'snek'))
+            self.assertEqual(len(statements), 1)
+
+            await service.get(PetService.get.request(2))
+            self.assertEqual(cache.get(('pet', 'PetMessage', 2))[0], PetMessage(2, 'noodle'))
+            await service.get(PetService.get.request(3))
+            self.assertEqual(len(cache), 2)
+            self.assertIsNone(cache.get(('pet', 'PetMessage', 1)))
+
+            await service.update(PetService.update.request(pet_id=3,
+                                                           pet=PetMessage(name='floof'),
+                                                           update_mask=FieldMask(['name'])))
+            self.assertIsNone(cache.get(('pet', 'PetMessage', 3)))
+            self.assertEqual(await service.get(PetService.get.request(3)), PetMessage(3, 'floof'))
+
+            await service.delete(PetService.delete.request(3))
+            with self.assertRaises(NotFound):
+                await service.get(PetService.get.request(3))
+
+    async def test_cache_message_variants(self):
+        class Pet(self.sa.Model):
+            id = self.sa.Column(self.sa.Integer(), primary_key=True)
+            secret = self.sa.Column(self.sa.String())
+
+        class FullPetMessage(Message):
+            id = Integer()
+            secret = String()
+
+        class PublicPetMessage(Message):
+            id = Integer()
+
+        self.sa.create_all()
+        cache = LRUCache()
+        full = SQLAlchemyResource(Pet, FullPetMessage, name='full_pets')
+        public = SQLAlchemyResource(Pet, PublicPetMessage, name='public_pets')
+        full.cache = public.cache = cache
+
+        with self.app.app_context():
+            self.sa.session.add(Pet(id=1, secret='snek'))
+            self.sa.session.commit()
+
+            self.assertEqual(full.get_message(1)[0], FullPetMessage(id=1, secret='snek'))
+            self.assertEqual(public.get_message(1)[0], PublicPetMessage(id=1))
+
+            full.update_by_id(1, FullPetMessage(secret='noodle'), FieldMask(['secret']))
+            self.assertIsNone(cache.get(('pet', 'FullPetMessage', 1)))
+            self.assertIsNone(cache.get(('pet', 'PublicPetMessage', 1)))
+
+    async def test_e2e_get_entity_etag(self):
+        Pet, PetMessage, PetService = self._setup_pet_service_case()
+
+        def get_etag():
+            return self.app.process_response(self.app.response_class()).get_etag()[0]
+
+        with self.app.app_context():
+            service = self.venom.get_instance(PetService)
+            await service.create(PetMessage(name='snek'))
+
+            with self.app.test_request_context('/pet/1'):
+                await service.get(PetService.get.request(1))
+                etag = get_etag()
+
+            for if_none_match in (f'"{etag}"', f'"other", W/"{etag}"', '*'):
+                with self.app.test_request_context('/pet/1', headers={'If-None-Match': if_none_match}):
+                    with self.assertRaises(NotModified):
+                        await service.get(PetService.get.request(1))
+                    self.assertEqual(get_etag(), etag)
+
+            with self.app.test_request_context('/pet/1', headers={'If-None-Match': f'"other", "{etag[1:]}"'}):
+                await service.get(PetService.get.request(1))
+
+            with self.app.test_request_context('/pet', method='POST'):
+                await service.list(PetService.list.request())
+                list_etag = get_etag()
+
+            # the list endpoint is a POST, which is never answered with 304
+            with self.app.test_request_context('/pet', method='POST', headers={'If-None-Match': f'"{list_etag}"'}):
+                await service.list(PetService.list.request())
+                self.assertEqual(get_etag(), list_etag)
+
+            await service.update(PetService.update.request(pet_id=1,
+                                                           pet=PetMessage(name='noodle'),
+                                                           update_mask=FieldMask(['name'])))
+
+            with self.app.test_request_context('/pet/1', headers={'If-None-Match': f'"{etag}"'}):
+                pet = await service.get(PetService.get.request(1))
+                self.assertEqual(pet.name, 'noodle')
+                self.assertNotEqual(get_etag(), etag)
+
+            with self.app.test_request_context('/pet', method='POST', headers={'If-None-Match': f'"{list_etag}"'}):
+                pets = await service.list(PetService.list.request())
+                self.assertEqual(list(pets.items), [pet])
+                self.assertNotEqual(get_etag(), list_etag)
+
     async def test_e2e_create_entity(self):
         Pet, PetMessage, PetService = self._setup_pet_service_case()
 
@@ -70,6 +188,36 @@ class DynamicResourceServiceTestCase(TestCase, metaclass=AioTestCaseMeta):
             self.assertEqual(pet.id, 1)
             self.assertEqual(pet.name, 'snek')
 
+    async def test_e2e_create_entity_without_reload(self):
+        class Pet(self.sa.Model):
+            id = self.sa.Column(self.sa.Integer(), primary_key=True)
+            name = self.sa.Column(self.sa.String(), nullable=True)
+            legs = self.sa.Column(self.sa.Integer(), server_default='0')
+
+        class PetMessage(Message):
+            id = Integer()
+            name = String()
+            legs = Integer()
+
+        self.sa.create_all()
+
+        class PetService(DynamicResourceService):
+            __resource__ = SQLAlchemyResource(Pet, PetMessage)
+
+        self.venom.add(PetService)
+
+        with self.app.app_context():
+            statements = []
+            event.listen(self.sa.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+            service = self.venom.get_instance(PetService)
+            self.assertEqual(await service.create(PetMessage(name='snek', legs=0)), PetMessage(1, 'snek', 0))
+            self.assertEqual(len(statements), 1)
+
+            # server defaults are read with a single statement
+            self.assertEqual(await service.create(PetMessage(name='noodle')), PetMessage(2, 'noodle', 0))
+            self.assertEqual(len(statements), 3)
+
     async def test_e2e_update_entity(self):
         Pet, PetMessage, PetService = self._setup_pet_service_case()
 
@@ -93,6 +241,58 @@ class DynamicResourceServiceTestCase(TestCase, metaclass=AioTestCaseMeta):
             self.assertEqual(pet.id, 1)
             self.assertEqual(pet.name, 'noodle')
 
+    async def test_e2e_update_entity_single_statement(self):
+        Pet, PetMessage, PetService = self._setup_pet_service_case()
+
+        with self.app.app_context():
+            service = self.venom.get_instance(PetService)
+            await service.create(PetMessage(name='snek'))
+            self.sa.session.remove()
+
+            statements = []
+            event.listen(self.sa.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+            pet = await service.update(PetService.update.request(pet_id=1,
+                                                                 pet=PetMessage(name='noodle'),
+                                                                 update_mask=FieldMask(['name'])))
+            self.assertEqual(pet, PetMessage(1, 'noodle'))
+
+            # SQLite has no RETURNING, so the row is read with a second statement
+            self.assertEqual(len(statements), 2)
+            self.assertTrue(statements[0].startswith('UPDATE pet SET name='))
+
+            with self.assertRaises(NotFound):
+                await service.update(PetService.update.request(pet_id=2,
+                                                               pet=PetMessage(name='fluff'),
+                                                               update_mask=FieldMask(['name'])))
+            self.assertEqual(len(statements), 3)
+
+            self.assertEqual(await service.get(PetService.get.request(1)), PetMessage(1, 'noodle'))
+
+    async def test_update_entity_update_events(self):
+        class Pet(self.sa.Model):
+            id = self.sa.Column(self.sa.Integer(), primary_key=True)
+            name = self.sa.Column(self.sa.String(), nullable=True)
+            stamp = self.sa.Column(self.sa.String(), nullable=True)
+
+        @event.listens_for(Pet, 'before_update')
+        def stamp(mapper, connection, target):
+            target.stamp = 'stamped'
+
+        class PetMessage(Message):
+            id = Integer()
+            name = String()
+            stamp = String()
+
+        self.sa.create_all()
+        pets = SQLAlchemyResource(Pet, PetMessage)
+        self.assertIsNone(pets._update_columns)
+
+        with self.app.app_context():
+            pets.create(PetMessage(name='snek'))
+            self.assertEqual(pets.update_by_id(1, PetMessage(name='noodle'), FieldMask(['name'])),
+                             PetMessage(id=1, name='noodle', stamp='stamped'))
+
     async def test_e2e_delete_entity(self):
         Pet, PetMessage, PetService = self._setup_pet_service_case()
 
@@ -110,6 +310,154 @@ class DynamicResourceServiceTestCase(TestCase, metaclass=AioTestCaseMeta):
             with self.assertRaises(NotFound):
                 await self.venom.get_instance(PetService).get(PetService.get.request(pet.id))
 
+    async def test_e2e_delete_entity_single_statement(self):
+        Pet, PetMessage, PetService = self._setup_pet_service_case()
+
+        with self.app.app_context():
+            service = self.venom.get_instance(PetService)
+            await service.create(PetMessage(name='snek'))
+            self.sa.session.remove()
+
+            statements = []
+            event.listen(self.sa.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+            await service.delete(PetService.delete.request(1))
+            self.assertEqual(statements, ['DELETE FROM pet WHERE pet.id = ?'])
+
+            with self.assertRaises(NotFound):
+                await service.delete(PetService.delete.request(1))
+
+    async def test_delete_entity_cascade(self):
+        class Person(self.sa.Model):
+            id = self.sa.Column(self.sa.Integer(), primary_key=True)
+
+        class Pet(self.sa.Model):
+            id = self.sa.Column(self.sa.Integer(), primary_key=True)
+            owner_id = self.sa.Column(self.sa.Integer(), self.sa.ForeignKey(Person.id))
+            owner = self.sa.relationship(Person, backref=self.sa.backref('pets', cascade='all, delete-orphan'))
+
+        class PersonMessage(Message):
+            id = Integer()
+
+        self.sa.create_all()
+        people = SQLAlchemyResource(Person, PersonMessage)
+        self.assertTrue(people._orm_delete_required)
+
+        with self.app.app_context():
+            self.sa.session.add(Person(id=1, pets=[Pet(), Pet()]))
+            self.sa.session.commit()
+
+            people.delete_by_id(1)
+            self.assertEqual(Pet.query.count(), 0)
+
+            with self.assertRaises(NotFound):
+                people.delete_by_id(1)
+
+    async def test_write_foreign_key(self):
+        class Person(self.sa.Model):
+            id = self.sa.Column(self.sa.Integer(), primary_key=True)
+
+        class Pet(self.sa.Model):
+            id = self.sa.Column(self.sa.Integer(), primary_key=True)
+            owner_id = self.sa.Column(self.sa.Integer(), self.sa.ForeignKey(Person.id))
+            owner = self.sa.relationship(Person)
+
+        class PersonMessage(Message):
+            id = Integer()
+
+        class PetMessage(Message):
+            id = Integer()
+            owner_id = Integer()
+
+        self.sa.create_all()
+        people = SQLAlchemyResource(Person, PersonMessage)
+        pets = SQLAlchemyResource(Pet, PetMessage, relationships={Relationship(people, 'owner', 'owner_id')})
+        pets.foreign_key_check = 'query'
+        self.assertEqual(pets._foreign_key_attributes, {'owner_id': 'owner_id'})
+
+        with self.app.app_context():
+            self.sa.session.add_all([Person(id=1), Person(id=2)])
+            self.sa.session.commit()
+            self.sa.session.remove()
+
+            statements = []
+            event.listen(self.sa.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+            self.assertEqual(pets.create_message(PetMessage(owner_id=1)), PetMessage(id=1, owner_id=1))
+            self.assertEqual(statements, [
+                'SELECT person.id AS person_id \nFROM person \nWHERE person.id IN (?)',
+                'INSERT INTO pet (owner_id) VALUES (?)'
+            ])
+
+            self.assertEqual(pets.update_by_id(1, PetMessage(owner_id=2), FieldMask(['owner_id'])),
+                             PetMessage(id=1, owner_id=2))
+
+            with self.assertRaises(NotFound):
+                pets.create_message(PetMessage(owner_id=3))
+
+            with self.assertRaises(NotFound):
+                pets.update_by_id(1, PetMessage(owner_id=3), FieldMask(['owner_id']))
+
+            # a foreign key violation when deleting means that the entity is still referenced
+            self.sa.session.execute('PRAGMA foreign_keys = ON')
+            people.foreign_key_check = pets.foreign_key_check = 'constraint'
+
+            with self.assertRaises(NotFound):
+                pets.create_message(PetMessage(owner_id=3))
+
+            with self.assertRaises(Conflict):
+                people.delete_by_id(2)
+
+            results = people.batch_delete([2, 1])
+            self.assertIsInstance(results[0], Conflict)
+            self.assertIsNone(results[1])
+
+    async def test_to_many_relationship(self):
+        pet_tags = self.sa.Table('pet_tags', self.sa.Model.metadata,
+                                 self.sa.Column('pet_id', self.sa.Integer(), self.sa.ForeignKey('pet.id')),
+                                 self.sa.Column('tag_id', self.sa.Integer(), self.sa.ForeignKey('tag.id')))
+
+        class Tag(self.sa.Model):
+            id = self.sa.Column(self.sa.Integer(), primary_key=True)
+
+        class Pet(self.sa.Model):
+            id = self.sa.Column(self.sa.Integer(), primary_key=True)
+            tags = self.sa.relationship(Tag, secondary=pet_tags)
+
+        class TagMessage(Message):
+            id = Integer()
+
+        class PetMessage(Message):
+            id = Integer()
+            tag_ids = RepeatField(Integer)
+
+        self.sa.create_all()
+        tags = SQLAlchemyResource(Tag, TagMessage)
+        pets = SQLAlchemyResource(Pet, PetMessage, relationships={Relationship(tags, 'tags', 'tag_ids')})
+
+        with self.app.app_context():
+            self.sa.session.add_all([Tag(id=1), Tag(id=2), Tag(id=3)])
+            self.sa.session.commit()
+
+            self.assertEqual(pets.create_message(PetMessage(tag_ids=[1, 2])), PetMessage(id=1, tag_ids=[1, 2]))
+            self.assertEqual(pets.create_message(PetMessage()), PetMessage(id=2, tag_ids=[]))
+
+            statements = []
+            event.listen(self.sa.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+            self.assertEqual(pets.update_by_id(1, PetMessage(tag_ids=[2, 3]), FieldMask(['tag_ids'])),
+                             PetMessage(id=1, tag_ids=[2, 3]))
+            self.assertIn('INSERT INTO pet_tags (pet_id, tag_id) VALUES (?, ?)', statements)
+            self.assertIn('DELETE FROM pet_tags WHERE pet_tags.pet_id = ? AND pet_tags.tag_id IN (?)', statements)
+
+            with self.assertRaises(NotFound):
+                pets.update_by_id(1, PetMessage(tag_ids=[4]), FieldMask(['tag_ids']))
+
+            statements.clear()
+            self.assertEqual(pets.format_many(Pet.query.all()), [PetMessage(id=1, tag_ids=[2, 3]),
+                                                                 PetMessage(id=2, tag_ids=[])])
+            self.assertEqual(len(statements), 2)
+
     async def test_e2e_list_entities(self):
         Pet, PetMessage, PetService = self._setup_pet_service_case()
 
@@ -117,15 +465,25 @@ class DynamicResourceServiceTestCase(TestCase, metaclass=AioTestCaseMeta):
         self.assertEqual(PetService.list.name, 'list_pets')
 
         self.assertEqual(fields(PetService.list.request), (
-            Field(JSONObject, name='filters', schema=PetService.__resource__.filter_schema),
-            RepeatField(JSONValue, schema=PetService.__resource__.order_schema, name='order'),
+            Field(JSONObject,
+                  name='filters',
+                  schema=PetService.__resource__.filter_schema,
+                  json_schema=PetService.__resource__.filter_json_schema),
+            RepeatField(JSONValue,
+                        schema=PetService.__resource__.order_schema,
+                        options={'json_schema': PetService.__resource__.order_json_schema},
+                        name='order'),
             String(name='page_token'),
-            Integer(name='page_size')
+            Integer(name='page_size'),
+            Field(FieldMask, name='read_mask'),
+            String(name='count_mode')
         ))
 
         self.assertEqual(fields(PetService.list.response), (
             String(name='next_page_token'),
-            RepeatField(PetMessage, name='items')
+            RepeatField(PetMessage, name='items'),
+            Integer(name='total_count'),
+            Bool(name='total_count_exact')
         ))
 
         with self.app.app_context():
@@ -137,3 +495,383 @@ class DynamicResourceServiceTestCase(TestCase, metaclass=AioTestCaseMeta):
 
             pets = await self.venom.get_instance(PetService).list(PetService.list.request())
             self.assertEquals(pets, PetService.list.response(None, [pet_1, pet_2]))
+
+    async def test_e2e_list_entities_pagination(self):
+        Pet, PetMessage, PetService = self._setup_pet_service_case()
+
+        with self.app.app_context():
+            service = self.venom.get_instance(PetService)
+            snek = await service.create(PetMessage(name='snek'))
+            noodle = await service.create(PetMessage(name='noodle'))
+            fluff = await service.create(PetMessage(name='fluff'))
+
+            pets = await service.list(PetService.list.request(page_size=2))
+            self.assertEqual(list(pets.items), [snek, noodle])
+            self.assertIsNotNone(pets.next_page_token)
+
+            pets = await service.list(PetService.list.request(page_size=2, page_token=pets.next_page_token))
+            self.assertEqual(list(pets.items), [fluff])
+            self.assertNotIn('next_page_token', pets)
+
+            pets = await service.list(PetService.list.request(order=['-name']))
+            self.assertEqual(list(pets.items), [snek, noodle, fluff])
+
+            pets = await service.list(PetService.list.request(order=[{'field': 'name', 'ascending': True}]))
+            self.assertEqual(list(pets.items), [fluff, noodle, snek])
+
+            pets = await service.list(PetService.list.request(filters={'name': ['snek', 'fluff']}))
+            self.assertEqual(list(pets.items), [snek, fluff])
+
+            with self.assertRaises(BadRequest):
+                await service.list(PetService.list.request(order=['-age']))
+
+            with self.assertRaises(BadRequest):
+                await service.list(PetService.list.request(filters={'age': 1}))
+
+    async def test_e2e_list_entities_unindexed_ordering(self):
+        class Pet(self.sa.Model):
+            id = self.sa.Column(self.sa.Integer(), primary_key=True)
+            name = self.sa.Column(self.sa.String(), index=True)
+            age = self.sa.Column(self.sa.Integer())
+            secret = self.sa.Column(self.sa.String(), index=True)
+
+        class PetMessage(Message):
+            id = Integer()
+            name = String()
+            age = Integer()
+
+        self.sa.create_all()
+
+        class PetService(DynamicResourceService):
+            __resource__ = SQLAlchemyResource(Pet, PetMessage)
+
+        self.venom.add(PetService)
+
+        resource = PetService.__resource__
+        self.assertEqual(resource.index_orderings, [('id',), ('name',), ('secret',)])
+        self.assertEqual(resource.order_json_schema['x-orderings'], [['id'], ['name', 'id']])
+        self.assertEqual(resource.order_json_schema['items']['anyOf'][0], {'enum': ['id', 'name', '-id', '-name']})
+        self.assertEqual(resource.parse_ordering(['-name']), [
+            {'field': 'name', 'ascending': False},
+            {'field': 'id', 'ascending': False}
+        ])
+
+        with self.app.app_context():
+            service = self.venom.get_instance(PetService)
+            await service.create(PetMessage(name='snek', age=2))
+            await service.create(PetMessage(name='noodle', age=1))
+
+            with self.assertRaises(BadRequest):
+                await service.list(PetService.list.request(order=['age']))
+
+            with self.assertRaises(BadRequest):
+                await service.list(PetService.list.request(order=['name', 'age']))
+
+            resource.allow_unindexed_ordering = True
+            pets = await service.list(PetService.list.request(order=['age']))
+            self.assertEqual([pet.name for pet in pets.items], ['noodle', 'snek'])
+
+            # columns that are not fields of the message are never ordered by
+            with self.assertRaises(BadRequest):
+                await service.list(PetService.list.request(order=['secret']))
+
+            # rows with null values would be skipped by keyset pagination
+            resource.keyset_pagination = True
+            with self.assertRaises(BadRequest):
+                await service.list(PetService.list.request(order=['age']))
+
+    async def test_e2e_list_entities_maximum_page_size(self):
+        Pet, PetMessage, PetService = self._setup_pet_service_case()
+
+        self.assertEqual(PetService.__resource__.maximum_page_size, 100)
+
+        with self.app.app_context():
+            service = self.venom.get_instance(PetService)
+            for i in range(101):
+                await service.create(PetMessage(name=f'pet-{i}'))
+
+            pets = await service.list(PetService.list.request(page_size=500))
+            self.assertEqual(len(pets.items), 100)
+            self.assertIsNotNone(pets.next_page_token)
+
+    async def test_e2e_list_entities_total_count(self):
+        Pet, PetMessage, PetService = self._setup_pet_service_case()
+        PetService.__resource__.count_cap = 2
+
+        with self.app.app_context():
+            service = self.venom.get_instance(PetService)
+            for name in ('snek', 'noodle', 'fluff'):
+                await service.create(PetMessage(name=name))
+
+            pets = await service.list(PetService.list.request(page_size=1))
+            self.assertNotIn('total_count', pets)
+
+            pets = await service.list(PetService.list.request(page_size=1, count_mode='exact'))
+            self.assertEqual((pets.total_count, pets.total_count_exact), (3, True))
+
+            pets = await service.list(PetService.list.request(count_mode='capped'))
+            self.assertEqual((pets.total_count, pets.total_count_exact), (2, False))
+
+            pets = await service.list(PetService.list.request(count_mode='estimate'))
+            self.assertEqual((pets.total_count, pets.total_count_exact), (2, False))
+
+            pets = await service.list(PetService.list.request(filters={'name': 'snek'}, count_mode='capped'))
+            self.assertEqual((pets.total_count, pets.total_count_exact), (1, True))
+
+            resource = PetService.__resource__
+            in_filters = resource.parse_filters({'name': {'$in': ['snek', 'scales']}})
+            expanding_filters = [Pet.name.in_(bindparam('names', ['snek', 'scales'], expanding=True))]
+            self.assertEqual(resource.count(in_filters), (1, True))
+            self.assertEqual(resource.count(expanding_filters), (1, True))
+
+            # with a TTL, counts are cached per filter set and are inexact since writes do not invalidate them
+            resource.count_cache_ttl = 30
+            self.assertEqual(resource.count(in_filters), (1, True))
+            self.assertEqual(resource.count(expanding_filters), (1, True))
+
+            await service.create(PetMessage(name='scales'))
+            self.assertEqual(resource.count(in_filters), (1, False))
+            self.assertEqual(resource.count(expanding_filters), (1, False))
+
+            resource.count_cache_ttl = None
+            pets = await service.list(PetService.list.request(count_mode='exact'))
+            self.assertEqual((pets.total_count, pets.total_count_exact), (4, True))
+            self.assertEqual(resource.count(expanding_filters), (2, True))
+
+            # PostgreSQL estimates are read from the query plan, with the parameters of the filters bound
+            statement = Pet.query.filter(*expanding_filters).statement
+            explain = _Explain(statement).compile(dialect=postgresql.dialect())
+            self.assertEqual(str(explain), f'EXPLAIN (FORMAT JSON) {statement.compile(dialect=postgresql.dialect())}')
+            self.assertEqual(explain.params, {'names': ['snek', 'scales']})
+
+            with self.assertRaises(BadRequest):
+                await service.list(PetService.list.request(count_mode='all'))
+
+    async def test_e2e_instrumentation(self):
+        Pet, PetMessage, PetService = self._setup_pet_service_case()
+        PetService.__resource__.instrumentation = collector = HistogramCollector()
+
+        class MetricsService(InstrumentationService):
+            class Meta:
+                instrumentation = collector
+
+        self.venom.add(MetricsService)
+        self.assertEqual(MetricsService.list_histograms.http_path, '/metrics/histograms')
+
+        with self.app.app_context():
+            service = self.venom.get_instance(PetService)
+            for name in ('snek', 'noodle', 'fluff'):
+                await service.create(PetMessage(name=name))
+
+            pets = await service.list(PetService.list.request(page_size=2, count_mode='exact'))
+            await service.list(PetService.list.request(page_size=2, page_token=pets.next_page_token))
+            await service.get(PetService.get.request(1))
+
+            self.assertEqual([(histogram['metric'], histogram['resource'], histogram['operation'], histogram['count'])
+                              for histogram in collector.histograms()], [
+                ('cursor_decode', 'pet', 'list', 1),
+                ('cursor_encode', 'pet', 'list', 1),
+                ('format', 'pet', 'create', 3),
+                ('format', 'pet', 'get', 1),
+                ('format', 'pet', 'list', 2),
+                ('query', 'pet', 'count', 1),
+                ('query', 'pet', 'get', 1),
+                ('query', 'pet', 'list', 2),
+                ('rows', 'pet', 'list', 2)
+            ])
+
+            response = await self.venom.get_instance(MetricsService).list_histograms(Empty())
+            rows = response.histograms[-1]
+            self.assertEqual((rows.metric, rows.count, rows.sum, rows.min, rows.max), ('rows', 2, 4, 1, 3))
+            self.assertEqual([(bucket.get('upper_bound'), bucket.count) for bucket in rows.buckets][:4],
+                             [(0, 0), (1, 1), (10, 1), (50, 0)])
+            self.assertNotIn('upper_bound', rows.buckets[-1])
+
+            collector.clear()
+            self.assertEqual(collector.histograms(), [])
+
+    async def test_export_entities(self):
+        Pet, PetMessage, PetService = self._setup_pet_service_case()
+        PetService.__resource__.export_chunk_size = 2
+
+        with self.app.app_context():
+            for i in range(5):
+                PetService.__resource__.create(PetMessage(name=f'pet-{i}'))
+            self.sa.session.remove()
+
+            service = self.venom.get_instance(PetService)
+
+            with self.app.test_request_context():
+                response = service.export()
+                self.assertEqual(response.mimetype, 'application/x-ndjson')
+
+                chunks = list(response.response)
+                self.assertEqual(len(chunks), 3)
+                self.assertEqual([json.loads(line) for line in b''.join(chunks).decode().splitlines()],
+                                 [{'id': i + 1, 'name': f'pet-{i}'} for i in range(5)])
+                self.assertEqual(len(self.sa.session.identity_map), 0)
+
+                response = service.export({'name': ['pet-1', 'pet-3']}, FieldMask(['name']))
+                self.assertEqual(b''.join(response.response), b'{"name": "pet-1"}\n{"name": "pet-3"}\n')
+
+    async def test_e2e_batch_entities(self):
+        class Pet(self.sa.Model):
+            id = self.sa.Column(self.sa.Integer(), primary_key=True)
+            name = self.sa.Column(self.sa.String(), nullable=True, unique=True)
+
+        class PetMessage(Message):
+            id = Integer()
+            name = String()
+
+        self.sa.create_all()
+
+        class PetService(DynamicResourceService):
+            __resource__ = SQLAlchemyResource(Pet, PetMessage)
+
+        PetService.__resource__.batch_chunk_size = 2
+        self.venom.add(PetService)
+
+        self.assertEqual(PetService.batch_create.http_path, '/pet/batch_create')
+        self.assertEqual(PetService.batch_create.name, 'batch_create_pets')
+        self.assertEqual(fields(PetService.batch_create.request), (RepeatField(PetMessage, name='items'),))
+        self.assertEqual(fields(PetService.batch_delete.request), (RepeatField(int, name='ids'),))
+        self.assertEqual(fields(PetService.batch_get.request), (
+            RepeatField(int, name='ids'),
+            Field(FieldMask, name='read_mask')
+        ))
+        self.assertEqual(PetService.batch_get.name, 'batch_get_pets')
+        self.assertEqual(fields(PetService.batch_create.response), (
+            RepeatField(PetMessage, name='items'),
+            RepeatField(BatchEntityError, name='errors')
+        ))
+
+        statements = []
+        event.listen(self.sa.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+        with self.app.app_context():
+            service = self.venom.get_instance(PetService)
+            response = await service.batch_create(PetService.batch_create.request([
+                PetMessage(name='snek'),
+                PetMessage(name='noodle'),
+                PetMessage(name='snek'),
+                PetMessage(name='fluff')
+            ]))
+
+            self.assertEqual(list(response.items), [
+                PetMessage(1, 'snek'),
+                PetMessage(2, 'noodle'),
+                PetMessage(3, 'fluff')
+            ])
+            self.assertEqual(list(response.errors), [BatchEntityError(index=2, status=409, description='Conflict')])
+            # the created entities are formatted before the commit, so that they are not reloaded
+            self.assertFalse([statement for statement in statements if statement.startswith('SELECT')])
+
+            response = await service.batch_update(PetService.batch_update.request([
+                PetService.update.request(pet_id=1, pet=PetMessage(name='snake'), update_mask=FieldMask(['name'])),
+                PetService.update.request(pet_id=4, pet=PetMessage(name='fido'), update_mask=FieldMask(['name'])),
+                PetService.update.request(pet_id=2, pet=PetMessage(name='fluff'), update_mask=FieldMask(['name'])),
+            ]))
+
+            self.assertEqual(list(response.items), [PetMessage(1, 'snake')])
+            self.assertEqual(list(response.errors), [
+                BatchEntityError(index=1, status=404, description='Not Found'),
+                BatchEntityError(index=2, status=409, description='Conflict')
+            ])
+
+            self.sa.session.remove()
+            statements.clear()
+
+            response = await service.batch_get(PetService.batch_get.request([3, 5, 1]))
+            self.assertEqual(list(response.items), [PetMessage(3, 'fluff'), PetMessage(1, 'snake')])
+            self.assertEqual(list(response.errors), [BatchEntityError(index=1, status=404, description='Not Found')])
+            self.assertEqual(len(statements), 1)
+
+            response = await service.batch_get(PetService.batch_get.request([2], read_mask=FieldMask(['name'])))
+            self.assertEqual(list(response.items), [PetMessage(name='noodle')])
+
+            response = await service.batch_delete(PetService.batch_delete.request([1, 4, 3]))
+            self.assertEqual(list(response.errors), [BatchEntityError(index=1, status=404, description='Not Found')])
+
+        with self.app.app_context():
+            self.assertEqual([(pet.id, pet.name) for pet in Pet.query.all()], [(2, 'noodle')])
+
+    async def test_e2e_executor(self):
+        class Pet(self.sa.Model):
+            id = self.sa.Column(self.sa.Integer(), primary_key=True)
+            name = self.sa.Column(self.sa.String(), nullable=True)
+
+        class PetMessage(Message):
+            id = Integer()
+            name = String()
+
+        self.sa.create_all()
+
+        class PetService(DynamicResourceService):
+            __resource__ = SQLAlchemyResource(Pet, PetMessage)
+
+            class Meta:
+                executor = ThreadPoolResourceExecutor(max_workers=2)
+
+        self.venom.add(PetService)
+
+        with self.app.app_context():
+            service = self.venom.get_instance(PetService)
+            snek = await service.create(PetMessage(name='snek'))
+            noodle = await service.create(PetMessage(name='noodle'))
+
+            threads = set()
+            event.listen(self.sa.engine, 'before_cursor_execute', lambda *args: threads.add(threading.get_ident()))
+
+            pets, pet = await asyncio.gather(service.list(PetService.list.request()),
+                                             service.get(PetService.get.request(1)))
+
+            self.assertEqual(list(pets.items), [snek, noodle])
+            self.assertEqual(pet, snek)
+
+            await service.update(PetService.update.request(pet_id=1,
+                                                           pet=PetMessage(name='floof'),
+                                                           update_mask=FieldMask(['name'])))
+            await service.delete(PetService.delete.request(2))
+            self.assertNotIn(threading.get_ident(), threads)
+
+            # entities loaded in a worker thread are merged into the session of the caller
+            entity = await PetService.__resource__.entity_loader.load(1)
+            PetService.__resource__.update(entity, PetMessage(name='fluff'), FieldMask(['name']))
+            self.sa.session.remove()
+            self.assertEqual([(pet.id, pet.name) for pet in Pet.query.all()], [(1, 'fluff')])
+
+    async def test_e2e_list_entities_column_projection(self):
+        class Pet(self.sa.Model):
+            id = self.sa.Column(self.sa.Integer(), primary_key=True)
+            name = self.sa.Column(self.sa.String(), nullable=True)
+            species = self.sa.Column(self.sa.String(), nullable=True)
+            notes = self.sa.Column(self.sa.Text(), nullable=True)
+
+        class PetMessage(Message):
+            id = Integer()
+            name = String()
+            species = String()
+
+        self.sa.create_all()
+
+        class PetService(DynamicResourceService):
+            __resource__ = SQLAlchemyResource(Pet, PetMessage)
+
+        self.venom.add(PetService)
+
+        with self.app.app_context():
+            service = self.venom.get_instance(PetService)
+            await service.create(PetMessage(name='snek', species='snake'))
+
+            statements = []
+            event.listen(self.sa.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+            pets = await service.list(PetService.list.request())
+            self.assertEqual(list(pets.items), [PetMessage(1, 'snek', 'snake')])
+            self.assertEqual(len(statements), 1)
+            self.assertNotIn('pet.notes', statements[0])
+
+            pets = await service.list(PetService.list.request(read_mask=FieldMask(['name'])))
+            self.assertEqual(list(pets.items), [PetMessage(name='snek')])
+            self.assertEqual(len(statements), 2)
+            self.assertNotIn('pet.species', statements[1])
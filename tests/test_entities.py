@@ -1,17 +1,19 @@
+import asyncio
 from typing import Tuple
 
 from flask_sqlalchemy import SQLAlchemy
 from flask_venom import Venom
 from flask_venom.test_utils import TestCase
+from sqlalchemy import event
 from venom import Message
 from venom.common import FieldMask
-from venom.exceptions import NotFound
+from venom.exceptions import NotFound, BadRequest
 from venom.fields import String, Int32
 from venom.rpc import http
 from venom.rpc.method import ServiceMethod
 from venom.rpc.test_utils import AioTestCaseMeta
 
-from venom_resource import SQLAlchemyResource, Relationship, ResourceService
+from venom_resource import SQLAlchemyResource, Relationship, ResourceService, HistogramCollector
 from venom_resource.methods import EntityMethodDescriptor
 
 
@@ -192,6 +194,24 @@ class ResourceServiceManagerTestCase(TestCase):
             self.assertEqual(result['previous_page_token'], None)
             self.assertEqual(result['next_page_token'], None)
 
+        resource.instrumentation = collector = HistogramCollector()
+
+        with self.app.app_context():
+            def encoded_cursors():
+                return sum(histogram['count'] for histogram in collector.histograms()
+                           if histogram['metric'] == 'cursor_encode')
+
+            # tokens are only encoded when they are looked up
+            result = resource.paginate(page_size=1)
+            self.assertIn('next_page_token', result)
+            self.assertEqual(encoded_cursors(), 0)
+
+            self.assertIsNotNone(result['next_page_token'])
+            self.assertIsNotNone(result['next_page_token'])
+            self.assertEqual(result['previous_page_token'], None)
+            self.assertEqual(result.get('total_count'), None)
+            self.assertEqual(encoded_cursors(), 1)
+
     def _create_person_pet_scenario(self) -> Tuple[type, type]:
         class Person(self.sa.Model):
             id = self.sa.Column(self.sa.Integer(), primary_key=True)
@@ -264,3 +284,209 @@ class ResourceServiceManagerTestCase(TestCase):
 
             fluff = pets.create(PetEntity(name='fluff', owner_id=1))
             self.assertEqual(pets.format(fluff), PetEntity(2, 'fluff', owner_id=1))
+
+    def test_parse_filters(self):
+        Person, Pet = self._create_person_pet_scenario()
+
+        class PersonEntity(Message):
+            id = Int32()
+            name = String()
+
+        class PetEntity(Message):
+            id = Int32()
+            name = String()
+            owner_id = Int32()
+
+        people = SQLAlchemyResource(Person, PersonEntity)
+        pets = SQLAlchemyResource(Pet, PetEntity, relationships={
+            Relationship(people, 'owner', 'owner_id')
+        })
+
+        with self.app.app_context():
+            foo = people.create(PersonEntity(name='foo'))
+            bar = people.create(PersonEntity(name='bar'))
+            pets.create(PetEntity(name='snek', owner_id=foo.id))
+            pets.create(PetEntity(name='noodle', owner_id=bar.id))
+            pets.create(PetEntity(name='snoot'))
+
+            def names(filters):
+                return [pet.name for pet in pets.paginate(filters=pets.parse_filters(filters))['items']]
+
+            self.assertEqual(names({'name': 'snek'}), ['snek'])
+            self.assertEqual(names({'name': ['snek', 'snoot']}), ['snek', 'snoot'])
+            self.assertEqual(names({'name': {'$startswith': 'sn'}}), ['snek', 'snoot'])
+            self.assertEqual(names({'id': {'$gt': 1, '$lt': 3}}), ['noodle'])
+            self.assertEqual(names({'$or': [{'name': 'snek'}, {'id': {'$gte': 3}}]}), ['snek', 'snoot'])
+            self.assertEqual(names({'owner_id': 1}), ['snek'])
+            self.assertEqual(names({'owner_id': None}), ['snoot'])
+            self.assertEqual(names({'owner_id.name': 'bar'}), ['noodle'])
+            self.assertEqual(names({'owner_id': {'name': {'$startswith': 'b'}}}), ['noodle'])
+
+            # compiled filters are reused for documents of the same shape
+            self.assertEqual(names({'name': 'noodle'}), ['noodle'])
+            self.assertEqual(len(pets._filter_compiler._cache), 9)
+
+            for filters in ({'age': 1},
+                            {'owner_id.age': 1},
+                            {'name': {'$like': 'snek'}},
+                            {'name': {'$in': 'snek'}},
+                            {'$or': {'name': 'snek'}},
+                            {'$nor': []}):
+                with self.assertRaises(BadRequest):
+                    pets.parse_filters(filters)
+
+        self.assertEqual(pets.filter_json_schema['properties']['name']['oneOf'][0], {'type': 'string'})
+
+    def test_parse_filters_hidden_column(self):
+        Person, Pet = self._create_person_pet_scenario()
+
+        class PersonEntity(Message):
+            id = Int32()
+
+        class PetEntity(Message):
+            id = Int32()
+            owner_id = Int32()
+
+        people = SQLAlchemyResource(Person, PersonEntity)
+        pets = SQLAlchemyResource(Pet, PetEntity, relationships={
+            Relationship(people, 'owner', 'owner_id')
+        })
+
+        with self.app.app_context():
+            self.assertEqual(len(pets.parse_filters({'owner_id': 1})), 1)
+
+            for resource, filters in ((pets, {'name': {'$startswith': 's'}}),
+                                      (pets, {'owner_id.name': 'foo'}),
+                                      (pets, {'owner_id': {'name': 'foo'}}),
+                                      (people, {'name': 'foo'})):
+                with self.assertRaises(BadRequest):
+                    resource.parse_filters(filters)
+
+        self.assertEqual(set(pets.filter_json_schema['properties']), {'id', 'owner_id', '$and', '$or'})
+
+    def test_format_many_relationship_to_one(self):
+        Person, Pet = self._create_person_pet_scenario()
+
+        class PersonEntity(Message):
+            id = Int32()
+            name = String()
+
+        class PetEntity(Message):
+            id = Int32()
+            name = String()
+            owner_id = Int32()
+
+        people = SQLAlchemyResource(Person, PersonEntity)
+        pets = SQLAlchemyResource(Pet, PetEntity, relationships={
+            Relationship(people, 'owner', 'owner_id')
+        })
+
+        with self.app.app_context():
+            foo = people.create(PersonEntity(name='foo'))
+            pets.create(PetEntity(name='snek', owner_id=foo.id))
+            pets.create(PetEntity(name='noodle'))
+
+        with self.app.app_context():
+            statements = []
+            event.listen(self.sa.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+            self.assertEqual(pets.format_many(Pet.query.order_by(Pet.id).all()), [
+                PetEntity(1, 'snek', owner_id=1),
+                PetEntity(2, 'noodle')
+            ])
+            self.assertEqual(len(statements), 1)
+
+    def test_get_entity_from_identity_map(self):
+        class Pet(self.sa.Model):
+            id = self.sa.Column(self.sa.Integer(), primary_key=True)
+            name = self.sa.Column(self.sa.String(), nullable=True)
+
+        self.sa.create_all()
+
+        pets = SQLAlchemyResource(Pet, PetEntity)
+
+        with self.app.app_context():
+            pets.create(PetEntity(name='snek'))
+
+        with self.app.app_context():
+            statements = []
+            event.listen(self.sa.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+            pet = pets.get(1)
+            self.assertEqual(pet.name, 'snek')
+            self.assertIs(pets.get(1), pet)
+            self.assertEqual(len(statements), 1)
+
+            self.assertIs(pets.get(1, Pet.name == 'snek'), pet)
+            self.assertEqual(len(statements), 2)
+
+            with self.assertRaises(NotFound):
+                pets.get(1, Pet.name == 'noodle')
+
+            with self.assertRaises(NotFound):
+                pets.get(2)
+
+    def test_entity_loader(self):
+        Person, Pet = self._create_person_pet_scenario()
+
+        class PersonEntity(Message):
+            id = Int32()
+            name = String()
+
+        class PetEntity(Message):
+            id = Int32()
+            name = String()
+            owner_id = Int32()
+
+        people = SQLAlchemyResource(Person, PersonEntity)
+        pets = SQLAlchemyResource(Pet, PetEntity, relationships={
+            Relationship(people, 'owner', 'owner_id')
+        })
+
+        with self.app.app_context():
+            for name in ('foo', 'bar', 'baz'):
+                people.create(PersonEntity(name=name))
+
+        with self.app.app_context():
+            statements = []
+            event.listen(self.sa.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+            loader = people.entity_loader
+            self.assertIs(people.entity_loader, loader)
+
+            results = asyncio.get_event_loop().run_until_complete(asyncio.gather(
+                loader.load(1), loader.load(3), loader.load(1), loader.load(4), return_exceptions=True))
+
+            self.assertEqual([person.name for person in results[:3]], ['foo', 'baz', 'foo'])
+            self.assertIsInstance(results[3], NotFound)
+            self.assertEqual(len(statements), 1)
+
+            self.assertIs(people.get(3), results[1])
+            self.assertEqual(len(statements), 1)
+
+        with self.app.app_context():
+            statements.clear()
+
+            pets.batch_create([PetEntity(name='snek', owner_id=1),
+                               PetEntity(name='noodle', owner_id=2),
+                               PetEntity(name='fluff', owner_id=1)])
+
+            self.assertEqual(len([statement for statement in statements if 'FROM person' in statement]), 1)
+
+    def test_format_many(self):
+        class Pet(self.sa.Model):
+            id = self.sa.Column(self.sa.Integer(), primary_key=True)
+            name = self.sa.Column(self.sa.String(), nullable=True)
+
+        self.sa.create_all()
+
+        pets = SQLAlchemyResource(Pet, PetEntity)
+
+        with self.app.app_context():
+            pets.create(PetEntity(name='snek'))
+            pets.create(PetEntity())
+
+        with self.app.app_context():
+            self.assertEqual(pets.format_many(Pet.query.order_by(Pet.id)), [PetEntity(1, 'snek'), PetEntity(2)])
+            self.assertEqual(pets.format_many([]), [])
+            self.assertIs(pets._formatter, pets._formatter)
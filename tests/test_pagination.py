@@ -1,3 +1,8 @@
+from datetime import datetime, date, time, timedelta, timezone
+from decimal import Decimal
+from enum import Enum
+from uuid import UUID
+
 from flask_sqlalchemy import SQLAlchemy
 from flask_venom import Venom
 from flask_venom.test_utils import TestCase
@@ -5,7 +10,7 @@ from sqlalchemy import func
 from venom.exceptions import NotFound
 from venom.rpc.test_utils import AioTestCaseMeta
 
-from venom_resource.backends.alchemy.pagination import CursorPagination
+from venom_resource.backends.alchemy.pagination import CursorPagination, Cursor
 
 
 class CursorPaginationTestCase(TestCase, metaclass=AioTestCaseMeta):
@@ -136,3 +141,151 @@ class CursorPaginationTestCase(TestCase, metaclass=AioTestCaseMeta):
         self.assertEqual(len(previous), 20)
         self.assertListEqual(current, ['U', 'V', 'W', 'X', 'Y', 'Z'])
         self.assertEqual(next, None)
+
+    async def test_cursor_pagination_duplicate_positions(self):
+        Pet = self._setup_pet_service_case()
+        self.sa.session.add_all(Pet(name=name) for name in 'AAABBBBBCDDD')
+
+        pagination = CursorPagination(Pet, 2, [{'field': 'name', 'ascending': True}])
+        pages, cursors, page_token = [], [], None
+        while True:
+            page = pagination.paginate_query(Pet.query, page_token)
+            pages.append(''.join(item.name for item in page))
+            page_token = pagination.get_next_token()
+            if page_token is None:
+                break
+            cursors.append(pagination.decode_cursor(page_token))
+
+        self.assertListEqual(pages, ['AA', 'AB', 'BB', 'BB', 'CD', 'DD'])
+        self.assertListEqual(cursors, [
+            Cursor(offset=2, reverse=False, position=None),
+            Cursor(offset=1, reverse=False, position='A'),
+            Cursor(offset=3, reverse=False, position='A'),
+            Cursor(offset=0, reverse=False, position='B'),
+            Cursor(offset=1, reverse=False, position='C')
+        ])
+
+    async def test_keyset_pagination(self):
+        Pet = self._setup_pet_service_case()
+
+        # all pets share the same created_at timestamp
+        created_at = datetime(2017, 1, 1, 12, 30)
+        self.sa.session.add_all([Pet(name=name, created_at=created_at) for name in 'ABCDEFGHIJ'])
+        self.sa.session.commit()
+
+        pagination = CursorPagination(Pet, 3, [{'field': 'created_at', 'ascending': True}], keyset=True)
+        self.assertListEqual(pagination.ordering, [
+            {'field': 'created_at', 'ascending': True},
+            {'field': 'id', 'ascending': True}
+        ])
+
+        pages, page_token = [], None
+        while True:
+            page = pagination.paginate_query(Pet.query, page_token)
+            pages.append([item.name for item in page])
+            page_token = pagination.get_next_token()
+            if page_token is None:
+                break
+
+        self.assertListEqual(pages, [['A', 'B', 'C'], ['D', 'E', 'F'], ['G', 'H', 'I'], ['J']])
+
+        previous_token = pagination.get_previous_token()
+        self.assertListEqual([item.name for item in pagination.paginate_query(Pet.query, previous_token)],
+                             ['G', 'H', 'I'])
+        self.assertListEqual([item.name for item in pagination.paginate_query(Pet.query,
+                                                                             pagination.get_next_token())],
+                             ['J'])
+
+        pagination = CursorPagination(Pet, 4, [{'field': 'created_at', 'ascending': True},
+                                               {'field': 'name', 'ascending': False}], keyset=True)
+        page = pagination.paginate_query(Pet.query)
+        self.assertListEqual([item.name for item in page], ['J', 'I', 'H', 'G'])
+        page = pagination.paginate_query(Pet.query, pagination.get_next_token())
+        self.assertListEqual([item.name for item in page], ['F', 'E', 'D', 'C'])
+
+        with self.assertRaises(NotFound):
+            # position does not match the ordering
+            pagination.paginate_query(Pet.query, pagination.encode_cursor(Cursor(0, False, ('A',))))
+
+    async def test_cursor_encoding(self):
+        Pet = self._setup_pet_service_case()
+        pagination = CursorPagination(Pet, 10, {'field': 'name', 'ascending': True})
+
+        for position in (None,
+                         'snek',
+                         42,
+                         2 ** 70,
+                         1.5,
+                         Decimal('1.50'),
+                         datetime(2017, 1, 1, 12, 30, 15, 123),
+                         datetime(2017, 1, 1, 12, 30, tzinfo=timezone(timedelta(hours=2))),
+                         date(2017, 1, 1),
+                         time(12, 30, 15, 123),
+                         time(12, 30, tzinfo=timezone(timedelta(hours=-3))),
+                         timedelta(days=-1, seconds=30),
+                         UUID('12345678-1234-5678-1234-567812345678'),
+                         's' * 70000):
+            cursor = Cursor(offset=5, reverse=True, position=position)
+            decoded = pagination.decode_cursor(pagination.encode_cursor(cursor))
+            self.assertEqual(decoded, cursor)
+            self.assertEqual(type(decoded.position), type(position))
+
+        keyset_pagination = CursorPagination(Pet, 10, [{'field': 'created_at', 'ascending': True},
+                                                       {'field': 'name', 'ascending': True}], keyset=True)
+        cursor = Cursor(offset=0, reverse=True, position=(datetime(2017, 1, 1), None, 1))
+        self.assertEqual(keyset_pagination.decode_cursor(keyset_pagination.encode_cursor(cursor)), cursor)
+
+        # the position must match the mode of the pagination
+        with self.assertRaises(NotFound):
+            pagination.decode_cursor(keyset_pagination.encode_cursor(cursor))
+
+        with self.assertRaises(NotFound):
+            keyset_pagination.decode_cursor(pagination.encode_cursor(Cursor(offset=0, reverse=False, position=1)))
+
+        self.assertEqual(pagination.decode_cursor(pagination.encode_cursor(Cursor(5000, False, None))),
+                         Cursor(pagination.offset_cutoff, False, None))
+
+        signed = CursorPagination(Pet, 10, {'field': 'name', 'ascending': True}, secret_key=b'secret')
+        token = signed.encode_cursor(Cursor(offset=0, reverse=False, position=42))
+        self.assertEqual(signed.decode_cursor(token), Cursor(offset=0, reverse=False, position=42))
+
+        with self.assertRaises(NotFound):
+            pagination.decode_cursor(token)
+
+        with self.assertRaises(NotFound):
+            signed.decode_cursor(pagination.encode_cursor(Cursor(offset=0, reverse=False, position=43)))
+
+    async def test_enum_pagination(self):
+        class Species(Enum):
+            cat = 'Cat'
+            dog = 'Dog'
+            snake = 'Snake'
+
+        class Pet(self.sa.Model):
+            id = self.sa.Column(self.sa.Integer(), primary_key=True)
+            name = self.sa.Column(self.sa.String(), nullable=True)
+            species = self.sa.Column(self.sa.Enum(Species), nullable=False)
+
+        self.sa.create_all()
+        self.sa.session.add_all([Pet(name=name, species=species)
+                                 for name, species in zip('ABCDE', [Species.snake, Species.cat, Species.dog,
+                                                                    Species.cat, Species.snake])])
+        self.sa.session.commit()
+
+        for keyset in (False, True):
+            pagination = CursorPagination(Pet, 2, [{'field': 'species', 'ascending': True}], keyset=keyset)
+
+            pages, page_token = [], None
+            while True:
+                page = pagination.paginate_query(Pet.query, page_token)
+                pages.append([item.name for item in page])
+                page_token = pagination.get_next_token()
+                if page_token is None:
+                    break
+
+            self.assertListEqual(pages, [['B', 'D'], ['C', 'A'], ['E']])
+
+        pagination = CursorPagination(Pet, 2, {'field': 'name', 'ascending': True})
+        with self.assertRaises(NotFound):
+            # the enum member cannot be resolved against a column without an enum class
+            pagination.decode_cursor(pagination.encode_cursor(Cursor(offset=0, reverse=False, position=Species.cat)))
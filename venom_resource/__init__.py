@@ -1,3 +1,5 @@
+from .cache import Cache, LRUCache
+from .instrumentation import Instrumentation, HistogramCollector
 from .resource import ResourceEntityConverter, ResourceEntityIDConverter, Relationship
-from venom_resource.backends.alchemy import SQLAlchemyResource
+from venom_resource.backends.alchemy import SQLAlchemyResource, ThreadPoolResourceExecutor
 from .service import ResourceService
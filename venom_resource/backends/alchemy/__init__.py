@@ -1 +1,2 @@
-from .resource import SQLAlchemyResource
\ No newline at end of file
+from .resource import SQLAlchemyResource
+from .executor import ThreadPoolResourceExecutor
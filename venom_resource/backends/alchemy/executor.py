@@ -0,0 +1,49 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Any
+
+from flask import current_app, has_request_context, copy_current_request_context
+
+
+class ThreadPoolResourceExecutor(object):
+    """
+    Runs the database work of a resource on a bounded thread pool so that blocking queries do not stall the event loop.
+
+    The Flask request context --- or, outside of a request, the application context --- of the caller is pushed in the
+    worker thread. Flask-SQLAlchemy scopes its session to the application context, so every call runs in a session of
+    its own that is removed when the call returns. Entities returned from the executor are therefore detached and
+    should be formatted before they are returned, or merged into the session of the caller with
+    :meth:`Resource.attach` before they are changed.
+
+    ::
+
+        class PetService(DynamicResourceService):
+            __resource__ = SQLAlchemyResource(Pet, PetMessage)
+
+            class Meta:
+                executor = ThreadPoolResourceExecutor(max_workers=8)
+
+    """
+
+    def __init__(self, max_workers: int = 4) -> None:
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def run(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        func = partial(func, *args, **kwargs)
+
+        if has_request_context():
+            func = copy_current_request_context(func)
+        else:
+            func = partial(self._run_in_app_context, current_app._get_current_object(), func)
+
+        return await asyncio.get_event_loop().run_in_executor(self._executor, func)
+
+    @staticmethod
+    def _run_in_app_context(app: 'flask.Flask', func: Callable[[], Any]) -> Any:
+        with app.app_context():
+            return func()
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
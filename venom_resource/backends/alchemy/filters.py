@@ -0,0 +1,257 @@
+import operator
+import re
+from datetime import datetime, date
+from decimal import Decimal
+from typing import Any, Callable, Dict, List, Mapping, Hashable
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.interfaces import MANYTOONE
+from venom.exceptions import BadRequest
+from venom.message import fields
+
+_Compiled_T = Callable[[Any], Any]
+
+OPERATORS: Dict[str, Callable[[Any, Any], Any]] = {
+    '$eq': operator.eq,
+    '$ne': operator.ne,
+    '$lt': operator.lt,
+    '$lte': operator.le,
+    '$gt': operator.gt,
+    '$gte': operator.ge,
+    '$in': lambda column, value: column.in_(value),
+    '$startswith': lambda column, value: column.startswith(value, autoescape=True)
+}
+
+JUNCTIONS = {
+    '$and': and_,
+    '$or': or_
+}
+
+_JSON_TYPES = {
+    bool: {'type': 'boolean'},
+    int: {'type': 'integer'},
+    float: {'type': 'number'},
+    Decimal: {'type': 'number'},
+    str: {'type': 'string'},
+    datetime: {'type': 'string', 'format': 'date-time'},
+    date: {'type': 'string', 'format': 'date'}
+}
+
+
+def _shape(value: Any, key: str = None) -> Hashable:
+    """
+    Returns a hashable description of the structure of a filter document --- its keys, operators and the types of
+    its values --- that does not depend on the values themselves.
+    """
+    if isinstance(value, Mapping):
+        return tuple((item_key, _shape(item, item_key)) for item_key, item in value.items())
+    if isinstance(value, list):
+        if key in JUNCTIONS:
+            return tuple(_shape(item) for item in value)
+        return list
+    return type(value)
+
+
+class FilterCompiler(object):
+    """
+    Compiles the ``filters`` of a list request to SQLAlchemy expressions for a :class:`SQLAlchemyResource`.
+
+    Each key of a filter document is either a field name of the model message or a junction. The value of a field is
+    either a value that must be equal, a list of values to match any of, or an object of operators::
+
+        {
+            "name": {"$startswith": "sn"},
+            "$or": [{"age": {"$lt": 2}}, {"age": {"$gte": 10}}],
+            "owner.name": "Alice"
+        }
+
+    Relationship fields match the id of the related entity. The fields of the related resource can be traversed
+    either with a dotted path or by nesting a filter document.
+
+    Documents are compiled once for each shape --- the same keys, operators and value types --- and the compiled
+    filter is then reused with the values of each request.
+    """
+
+    cache_size = 1024
+
+    def __init__(self, resource: 'venom_resource.SQLAlchemyResource') -> None:
+        self.resource = resource
+        self._cache: Dict[Hashable, _Compiled_T] = {}
+
+    def compile(self, filters: Mapping[str, Any]) -> List[Any]:
+        if not filters:
+            return []
+
+        shape = _shape(filters)
+        try:
+            compiled = self._cache[shape]
+        except KeyError:
+            compiled = self._compile_document(self.resource, filters)
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[shape] = compiled
+
+        return compiled(filters)
+
+    def _compile_document(self, resource, document: Any) -> Callable[[Mapping[str, Any]], List[Any]]:
+        if not isinstance(document, Mapping):
+            raise BadRequest(f'Invalid filter: {document!r}')
+
+        compiled = [(key, self._compile_item(resource, key, value)) for key, value in document.items()]
+
+        def apply(values):
+            return [compile_(values[key]) for key, compile_ in compiled]
+        return apply
+
+    def _compile_item(self, resource, key: str, value: Any) -> _Compiled_T:
+        if key in JUNCTIONS:
+            if not isinstance(value, list):
+                raise BadRequest(f'Invalid filter for "{key}"')
+
+            junction = JUNCTIONS[key]
+            documents = [self._compile_document(resource, item) for item in value]
+
+            def apply(values):
+                return junction(*(expression
+                                  for document, item in zip(documents, values)
+                                  for expression in document(item)))
+            return apply
+
+        if key.startswith('$'):
+            raise BadRequest(f'Unknown filter operator: "{key}"')
+        return self._compile_field(resource, key.split('.'), value)
+
+    def _compile_field(self, resource, path: List[str], value: Any) -> _Compiled_T:
+        name, path = path[0], path[1:]
+
+        if name in resource._relationships:
+            return self._compile_relationship(resource, name, path, value)
+
+        if name not in resource._message_column_names or path:
+            raise BadRequest(f'Unable to filter by "{name}"')
+
+        return self._compile_condition(name, getattr(resource.model, name), value)
+
+    def _compile_relationship(self, resource, name: str, path: List[str], value: Any) -> _Compiled_T:
+        relationship = resource._relationships[name]
+        related_resource = resource.resolve(relationship.resource)
+        attribute = getattr(resource.model, relationship.name)
+        match = attribute.any if attribute.property.uselist else attribute.has
+
+        if not path and isinstance(value, Mapping) and not all(key.startswith('$') for key in value):
+            document = self._compile_document(related_resource, value)
+
+            def apply(values):
+                return match(and_(*document(values)))
+            return apply
+
+        if not path:
+            prop = attribute.property
+            if prop.direction is MANYTOONE and len(prop.local_remote_pairs) == 1:
+                (local_column, remote_column), = prop.local_remote_pairs
+                if remote_column is related_resource.model_id_column:
+                    # compare the foreign key rather than query the related table
+                    return self._compile_condition(name, local_column, value)
+
+        if path:
+            compiled = self._compile_field(related_resource, path, value)
+        else:
+            compiled = self._compile_condition(name, related_resource.model_id_column, value)
+
+        def apply(values):
+            return match(compiled(values))
+        return apply
+
+    @staticmethod
+    def _compile_condition(name: str, column, value: Any) -> _Compiled_T:
+        if isinstance(value, list):
+            return column.in_
+
+        if not isinstance(value, Mapping):
+            return column.__eq__
+
+        conditions = []
+        for key, operand in value.items():
+            try:
+                operator_ = OPERATORS[key]
+            except KeyError:
+                raise BadRequest(f'Unknown filter operator for "{name}": "{key}"')
+
+            if isinstance(operand, Mapping) \
+                    or (key == '$in') != isinstance(operand, list) \
+                    or (key == '$startswith' and not isinstance(operand, str)):
+                raise BadRequest(f'Invalid operand of "{key}" for "{name}"')
+
+            conditions.append((key, operator_))
+
+        if len(conditions) == 1:
+            (key, operator_), = conditions
+
+            def apply(values):
+                return operator_(column, values[key])
+            return apply
+
+        def apply(values):
+            return and_(*(operator_(column, values[key]) for key, operator_ in conditions))
+        return apply
+
+    def json_schema(self) -> Dict[str, Any]:
+        """
+        Returns a JSON schema of the filter documents accepted by :meth:`compile`.
+        """
+        resource = self.resource
+        mapper = class_mapper(resource.model)
+        properties = {}
+        pattern_properties = {}
+
+        for name in sorted(resource._message_column_names):
+            properties[name] = self._condition_schema(self._column_schema(mapper.get_property(name).columns[0]))
+
+        for field in fields(resource.model_message):
+            if field.name in resource._relationships:
+                id_schema = _JSON_TYPES.get(field.type, {})
+                properties[field.name] = {
+                    'oneOf': self._condition_schema(id_schema)['oneOf'] + [{'$ref': '#'}]
+                }
+                pattern_properties[f'^{re.escape(field.name)}\\.'] = {}
+
+        for junction in JUNCTIONS:
+            properties[junction] = {'type': 'array', 'items': {'$ref': '#'}}
+
+        return {
+            'type': 'object',
+            'properties': properties,
+            'patternProperties': pattern_properties,
+            'additionalProperties': False
+        }
+
+    @staticmethod
+    def _column_schema(column) -> Dict[str, Any]:
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            return {}
+
+        for type_, schema in _JSON_TYPES.items():
+            if issubclass(python_type, type_):
+                return schema
+        return {}
+
+    @staticmethod
+    def _condition_schema(value_schema: Dict[str, Any]) -> Dict[str, Any]:
+        operators = {key: value_schema for key in OPERATORS}
+        operators['$in'] = {'type': 'array', 'items': value_schema}
+
+        if value_schema.get('type') == 'string':
+            operators['$startswith'] = {'type': 'string'}
+        else:
+            del operators['$startswith']
+
+        return {
+            'oneOf': [
+                value_schema,
+                {'type': 'array', 'items': value_schema},
+                {'type': 'object', 'properties': operators, 'additionalProperties': False}
+            ]
+        }
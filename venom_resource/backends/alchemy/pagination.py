@@ -1,12 +1,24 @@
-from base64 import b64decode, b64encode
+import hmac
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
 from collections import namedtuple
-from typing import Any, Dict, List, Union
-from urllib.parse import parse_qs, urlencode
+from collections.abc import Mapping
+from datetime import date, datetime, time, timedelta, timezone
+from decimal import Decimal
+from enum import Enum
+from hashlib import sha256
+from operator import attrgetter, itemgetter
+from struct import Struct, error as StructError
+from typing import Any, Dict, List, Union, Tuple, Iterator
+from uuid import UUID
 
 from flask_sqlalchemy import Model
-from sqlalchemy import asc, desc
+from sqlalchemy import asc, desc, and_, or_, tuple_, literal
+from sqlalchemy.orm import class_mapper
 from venom.exceptions import NotFound
 
+from venom_resource.instrumentation import Instrumentation, NULL_TIMER
+
 
 def _positive_int(integer_string, strict=False, cutoff=None):
     """
@@ -50,15 +62,189 @@ def convert_ordering_to_alchmey_clauses(model, ordering):
     return clauses
 
 
+_EPOCH = datetime(1970, 1, 1)
+_NAIVE = -0x80000000
+
+_pack_header = Struct('>BH').pack
+_unpack_header = Struct('>BH').unpack_from
+_CURSOR_REVERSE = 1
+_CURSOR_POSITION = 2
+_CURSOR_KEYSET = 4
+
+_int64 = Struct('>q')
+_float64 = Struct('>d')
+_datetime = Struct('>qi')
+_int32 = Struct('>i')
+_length = Struct('>I')
+
+
+def _pack_value(value: Any) -> bytes:
+    """
+    Pack a column value into a tagged binary representation that :func:`_unpack_value` reads back as the same type.
+
+    Enum members are stored by name, which :meth:`CursorPagination.decode_cursor` looks up in the enum class of the
+    column.
+    """
+    if value is None:
+        return b'N'
+    if isinstance(value, Enum):
+        return b'e' + _pack_bytes(value.name.encode('utf-8'))
+    if value is True:
+        return b'T'
+    if value is False:
+        return b'F'
+    if isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+        return b'i' + _int64.pack(value)
+    if isinstance(value, float):
+        return b'f' + _float64.pack(value)
+    if isinstance(value, datetime):
+        offset = value.utcoffset()
+        microseconds = (value.replace(tzinfo=None) - _EPOCH) // timedelta(microseconds=1)
+        return b'D' + _datetime.pack(microseconds, offset // timedelta(seconds=1) if offset is not None else _NAIVE)
+    if isinstance(value, date):
+        return b'd' + _int32.pack(value.toordinal())
+    if isinstance(value, time):
+        offset = value.utcoffset()
+        microseconds = (datetime.combine(_EPOCH, value.replace(tzinfo=None)) - _EPOCH) // timedelta(microseconds=1)
+        return b't' + _datetime.pack(microseconds, offset // timedelta(seconds=1) if offset is not None else _NAIVE)
+    if isinstance(value, timedelta):
+        return b'p' + _int64.pack(value // timedelta(microseconds=1))
+    if isinstance(value, UUID):
+        return b'u' + value.bytes
+    if isinstance(value, int):
+        return b'I' + _pack_bytes(str(value).encode('ascii'))
+    if isinstance(value, Decimal):
+        return b'n' + _pack_bytes(str(value).encode('ascii'))
+    if isinstance(value, str):
+        return b's' + _pack_bytes(value.encode('utf-8'))
+    if isinstance(value, bytes):
+        return b'b' + _pack_bytes(value)
+    raise TypeError(f'Unable to store {value!r} in a cursor')
+
+
+def _pack_bytes(value: bytes) -> bytes:
+    return _length.pack(len(value)) + value
+
+
+def _unpack_bytes(data: bytes, index: int) -> Tuple[bytes, int]:
+    length, = _length.unpack_from(data, index)
+    index += _length.size
+    if index + length > len(data):
+        raise ValueError()
+    return data[index:index + length], index + length
+
+
+def _unpack_value(data: bytes, index: int) -> Tuple[Any, int]:
+    tag, index = data[index:index + 1], index + 1
+
+    if tag == b'N':
+        return None, index
+    if tag == b'T':
+        return True, index
+    if tag == b'F':
+        return False, index
+    if tag == b'i':
+        return _int64.unpack_from(data, index)[0], index + _int64.size
+    if tag == b'f':
+        return _float64.unpack_from(data, index)[0], index + _float64.size
+    if tag == b'D':
+        microseconds, offset = _datetime.unpack_from(data, index)
+        value = _EPOCH + timedelta(microseconds=microseconds)
+        if offset != _NAIVE:
+            value = value.replace(tzinfo=timezone(timedelta(seconds=offset)))
+        return value, index + _datetime.size
+    if tag == b'd':
+        return date.fromordinal(_int32.unpack_from(data, index)[0]), index + _int32.size
+    if tag == b't':
+        microseconds, offset = _datetime.unpack_from(data, index)
+        value = (_EPOCH + timedelta(microseconds=microseconds)).time()
+        if offset != _NAIVE:
+            value = value.replace(tzinfo=timezone(timedelta(seconds=offset)))
+        return value, index + _datetime.size
+    if tag == b'p':
+        return timedelta(microseconds=_int64.unpack_from(data, index)[0]), index + _int64.size
+    if tag == b'u':
+        return UUID(bytes=data[index:index + 16]), index + 16
+    if tag == b'I':
+        value, index = _unpack_bytes(data, index)
+        return int(value.decode('ascii')), index
+    if tag == b'n':
+        value, index = _unpack_bytes(data, index)
+        return Decimal(value.decode('ascii')), index
+    if tag == b's':
+        value, index = _unpack_bytes(data, index)
+        return value.decode('utf-8'), index
+    if tag == b'b':
+        return _unpack_bytes(data, index)
+    if tag == b'e':
+        value, index = _unpack_bytes(data, index)
+        return _EnumName(value.decode('utf-8')), index
+    raise ValueError()
+
+
+class _EnumName(str):
+    """
+    The name of an enum member read from a cursor, which is resolved against the enum class of its column.
+    """
+
+
 Cursor = namedtuple('Cursor', ['offset', 'reverse', 'position'])
 _Ordering_T = Union[List[Dict[str, Any]], Dict[str, Any]]
 
 
+class Page(Mapping):
+    """
+    The result of :meth:`SQLAlchemyResource.paginate`: a mapping of the ``items`` of a page, its ``next_page_token``
+    and ``previous_page_token`` and any other values, such as the total count.
+
+    The tokens are only encoded when they are looked up, so that responses without them do not pay for either.
+    """
+    _tokens = {
+        'next_page_token': 'get_next_token',
+        'previous_page_token': 'get_previous_token'
+    }
+
+    def __init__(self, pagination: 'CursorPagination', **values: Any) -> None:
+        self._pagination = pagination
+        self._values = dict(values, items=pagination.page)
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return self._values[key]
+        except KeyError:
+            if key not in self._tokens:
+                raise
+
+        value = self._values[key] = getattr(self._pagination, self._tokens[key])()
+        return value
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._values or key in self._tokens
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self._values
+        yield from (key for key in self._tokens if key not in self._values)
+
+    def __len__(self) -> int:
+        return len(self._values.keys() | self._tokens.keys())
+
+
 class CursorPagination(object):
     """
     The cursor pagination implementation is necessarily complex.
     For an overview of the position/offset style we use, see this post:
     http://cramer.io/2011/03/08/building-cursors-for-the-disqus-api
+
+    With ``keyset=True`` the primary key is appended to the ordering as a tiebreaker and the cursor position holds
+    the values of every ordering column. Each page is then selected with a row-value comparison such as
+    ``(a, b, id) > (:a, :b, :id)``, so that no offset is ever needed regardless of duplicates in the leading column.
+    Keyset pagination requires the ordering columns to be non-nullable.
+
+    Cursor positions keep the type of their column (see :meth:`encode_cursor`), so datetimes and numbers are compared
+    as such rather than as strings.
+
+    If an ``instrumentation`` is given, the time spent querying each page, the number of rows and the time spent
+    encoding and decoding cursors are observed for ``resource_name``.
     """
     cursor_query_param = 'cursor'
     page_size = None
@@ -70,7 +256,21 @@ class CursorPagination(object):
     # queries, by having a hard cap on the maximum possible size of the offset.
     offset_cutoff = 1000
 
-    def __init__(self, model: Model, page_size: int, ordering: _Ordering_T):
+    # Cursors are signed when a secret key is given, so that clients cannot craft positions of their own.
+    secret_key: bytes = None
+    signature_size = 12
+
+    # The operation that observations are tagged with.
+    operation = 'list'
+
+    def __init__(self,
+                 model: Model,
+                 page_size: int,
+                 ordering: _Ordering_T,
+                 keyset: bool = False,
+                 secret_key: bytes = None,
+                 instrumentation: Instrumentation = None,
+                 resource_name: str = None):
         assert isinstance(ordering, (dict, list, tuple)), (
             'Invalid ordering. Expected dict or tuple, but got {type}'.format(
                 type=type(ordering).__name__
@@ -81,33 +281,51 @@ class CursorPagination(object):
 
         self.model = model
         self.page_size = page_size
+        self.keyset = keyset
+        self.instrumentation = instrumentation
+        self.resource_name = resource_name
+        self._page_positions = None
+
+        if secret_key is not None:
+            self.secret_key = secret_key
 
+        mapper = class_mapper(model)
         self.ordering = []
 
         for order in ordering:
-            if not hasattr(self.model, order['field']):
-                continue
-
-            if order.get('ascending') is None:
-                continue
-
+            assert order.get('field') in mapper.column_attrs, (
+                'Invalid ordering. Unknown field {field!r}'.format(field=order.get('field'))
+            )
+            assert order.get('ascending') is not None, (
+                'Invalid ordering. Expected an ascending value for {field!r}'.format(field=order['field'])
+            )
             self.ordering.append(order)
 
         assert len(self.ordering) > 0, (
-            'Invalid ordering. Expected at lease one value with '
-            'correct ascending value but got {ordering}'.format(
+            'Invalid ordering. Expected at least one value but got {ordering}'.format(
                 ordering=ordering
             )
         )
 
+        if keyset:
+            ordering_fields = {order['field'] for order in self.ordering}
+            for column in mapper.primary_key:
+                field = mapper.get_property_by_column(column).key
+                if field not in ordering_fields:
+                    self.ordering.append({'field': field, 'ascending': self.ordering[-1]['ascending']})
+
     def paginate_query(self, query, page_token: str = None):
         self.cursor = self.decode_cursor(page_token)
+        self._page_positions = None
 
         if self.cursor is None:
             (offset, reverse, current_position) = (0, False, None)
         else:
             (offset, reverse, current_position) = self.cursor
 
+        if self.keyset:
+            return self._paginate_keyset_query(query, reverse, current_position)
+
         # Cursor pagination always enforces an ordering.
         if reverse:
             ordering_clauses = convert_ordering_to_alchmey_clauses(self.model,
@@ -137,7 +355,7 @@ class CursorPagination(object):
         # If we have an offset cursor then offset the entire page by that amount.
         # We also always fetch an extra item in order to determine if there is a
         # page following on from this one.
-        results = list(query[offset:offset + self.page_size + 1])
+        results = self._fetch(query.slice(offset, offset + self.page_size + 1))
         self.page = list(results[:self.page_size])
 
         # Determine the position of the final item following the page.
@@ -172,6 +390,69 @@ class CursorPagination(object):
 
         return self.page
 
+    def _paginate_keyset_query(self, query, reverse: bool, current_position: Tuple[Any, ...] = None):
+        ordering = _reverse_ordering(self.ordering) if reverse else self.ordering
+        query = query.order_by(*convert_ordering_to_alchmey_clauses(self.model, ordering))
+
+        if current_position is not None:
+            query = query.filter(self._get_keyset_clause(ordering, current_position))
+
+        results = self._fetch(query.slice(0, self.page_size + 1))
+        self.page = list(results[:self.page_size])
+        has_following_position = len(results) > len(self.page)
+
+        if reverse:
+            self.page = list(reversed(self.page))
+            self.has_next = current_position is not None
+            self.has_previous = has_following_position
+        else:
+            self.has_next = has_following_position
+            self.has_previous = current_position is not None
+
+        # An empty page (e.g. after the following rows were deleted) continues from the position of the cursor.
+        if self.page:
+            self.previous_position = self._get_keyset_position_from_instance(self.page[0])
+            self.next_position = self._get_keyset_position_from_instance(self.page[-1])
+        else:
+            self.previous_position = self.next_position = current_position
+
+        return self.page
+
+    def _fetch(self, query) -> List[Any]:
+        with self._timer('query'):
+            results = list(query)
+
+        if self.instrumentation is not None:
+            self.instrumentation.observe('rows', len(results), self.resource_name, self.operation)
+        return results
+
+    def _timer(self, metric: str):
+        if self.instrumentation is None:
+            return NULL_TIMER
+        return self.instrumentation.timer(metric, self.resource_name, self.operation)
+
+    def _get_keyset_clause(self, ordering, position: Tuple[Any, ...]):
+        """
+        Returns a clause matching the rows that follow ``position`` in ``ordering``.
+        """
+        columns = [getattr(self.model, order['field']) for order in ordering]
+        values = [literal(value, column.type) for column, value in zip(columns, position)]
+
+        def follows(column, value, ascending):
+            return column > value if ascending else column < value
+
+        if len({order['ascending'] for order in ordering}) == 1:
+            ascending = ordering[0]['ascending']
+            if len(columns) == 1:
+                return follows(columns[0], values[0], ascending)
+            return follows(tuple_(*columns), tuple_(*values), ascending)
+
+        # Row-value comparisons cannot mix directions, so mixed orderings are expanded into
+        # (a > :a) OR (a = :a AND b < :b) OR ...
+        return or_(*(and_(*[column == value for column, value in zip(columns[:i], values[:i])],
+                          follows(columns[i], values[i], ordering[i]['ascending']))
+                     for i in range(len(columns))))
+
     def get_page_size(self, request):
         return self.page_size
 
@@ -179,28 +460,27 @@ class CursorPagination(object):
         if not self.has_next:
             return None
 
+        if self.keyset:
+            return self.encode_cursor(Cursor(offset=0, reverse=False, position=self.next_position))
+
+        positions, leading, trailing = self._get_page_positions()
+
         if self.cursor and self.cursor.reverse and self.cursor.offset != 0:
             # If we're reversing direction and we have an offset cursor
             # then we cannot use the first position we find as a marker.
-            compare = self._get_position_from_instance(self.page[-1], self.ordering)
+            compare = positions[-1] if positions else None
         else:
             compare = self.next_position
-        offset = 0
-
-        for item in reversed(self.page):
-            position = self._get_position_from_instance(item, self.ordering)
-            if position != compare:
-                # The item in this position and the item following it
-                # have different positions. We can use this position as
-                # our marker.
-                break
-
-            # The item in this position has the same position as the item
-            # following it, we can't use it as a marker position, so increment
-            # the offset and keep seeking to the previous item.
-            compare = position
-            offset += 1
 
+        if positions and positions[-1] != compare:
+            # The last item and the item following it have different
+            # positions. We can use this position as our marker.
+            offset, position = 0, positions[-1]
+        elif trailing < len(positions):
+            # The items at the end of the page have the same position as
+            # the item following them, so we can't use them as a marker.
+            # Use the position before them, offset by their number.
+            offset, position = trailing, positions[-1 - trailing]
         else:
             # There were no unique positions in the page.
             if not self.has_previous:
@@ -227,28 +507,27 @@ class CursorPagination(object):
         if not self.has_previous:
             return None
 
+        if self.keyset:
+            return self.encode_cursor(Cursor(offset=0, reverse=True, position=self.previous_position))
+
+        positions, leading, trailing = self._get_page_positions()
+
         if self.cursor and not self.cursor.reverse and self.cursor.offset != 0:
             # If we're reversing direction and we have an offset cursor
             # then we cannot use the first position we find as a marker.
-            compare = self._get_position_from_instance(self.page[0], self.ordering)
+            compare = positions[0] if positions else None
         else:
             compare = self.previous_position
-        offset = 0
-
-        for item in self.page:
-            position = self._get_position_from_instance(item, self.ordering)
-            if position != compare:
-                # The item in this position and the item following it
-                # have different positions. We can use this position as
-                # our marker.
-                break
-
-            # The item in this position has the same position as the item
-            # following it, we can't use it as a marker position, so increment
-            # the offset and keep seeking to the previous item.
-            compare = position
-            offset += 1
 
+        if positions and positions[0] != compare:
+            # The first item and the item preceding it have different
+            # positions. We can use this position as our marker.
+            offset, position = 0, positions[0]
+        elif leading < len(positions):
+            # The items at the start of the page have the same position as
+            # the item preceding them, so we can't use them as a marker.
+            # Use the position after them, offset by their number.
+            offset, position = leading, positions[leading]
         else:
             # There were no unique positions in the page.
             if not self.has_next:
@@ -271,6 +550,33 @@ class CursorPagination(object):
         cursor = Cursor(offset=offset, reverse=True, position=position)
         return self.encode_cursor(cursor)
 
+    def _get_page_positions(self) -> Tuple[List[Any], int, int]:
+        """
+        Returns the positions of the items of the page, followed by the number of items at the start of the page that
+        share the position of the first item and the number of items at the end that share the position of the last.
+
+        The positions are computed once for each page, so that both tokens can be derived from them.
+        """
+        if self._page_positions is None:
+            field = self.ordering[0]['field']
+            getter = itemgetter(field) if self.page and isinstance(self.page[0], dict) else attrgetter(field)
+            positions = list(map(getter, self.page))
+            count = len(positions)
+
+            leading = 1 if positions else 0
+            while leading < count and positions[leading] == positions[0]:
+                leading += 1
+
+            if leading == count:
+                trailing = count
+            else:
+                trailing = 1
+                while positions[-1 - trailing] == positions[-1]:
+                    trailing += 1
+
+            self._page_positions = positions, leading, trailing
+        return self._page_positions
+
     def decode_cursor(self, encoded: str) -> Cursor:
         """
         Given a request with a cursor, return a `Cursor` instance.
@@ -279,37 +585,92 @@ class CursorPagination(object):
         if not encoded:
             return None
 
-        try:
-            querystring = b64decode(encoded.encode('ascii')).decode('ascii')
-            tokens = parse_qs(querystring, keep_blank_values=True)
-
-            offset = tokens.get('o', ['0'])[0]
-            offset = _positive_int(offset, cutoff=self.offset_cutoff)
-
-            reverse = tokens.get('r', ['0'])[0]
-            reverse = bool(int(reverse))
-
-            position = tokens.get('p', [None])[0]
-        except (TypeError, ValueError):
-            raise NotFound(self.invalid_cursor_message)
+        with self._timer('cursor_decode'):
+            try:
+                data = urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+
+                if self.secret_key is not None:
+                    data, signature = data[:-self.signature_size], data[-self.signature_size:]
+                    if not hmac.compare_digest(signature, self._sign(data)):
+                        raise ValueError()
+
+                flags, offset = _unpack_header(data)
+                offset = _positive_int(offset, cutoff=self.offset_cutoff)
+                reverse = bool(flags & _CURSOR_REVERSE)
+                index = 3
+
+                # the position must have the shape of the mode: a value for each ordering column with keyset
+                # pagination and a single value of the leading column otherwise
+                if flags & _CURSOR_KEYSET:
+                    if not self.keyset:
+                        raise ValueError()
+
+                    count, index = data[index], index + 1
+                    if count != len(self.ordering):
+                        raise ValueError()
+
+                    position = []
+                    for i in range(count):
+                        value, index = _unpack_value(data, index)
+                        position.append(self._resolve_value(i, value))
+                    position = tuple(position)
+                elif flags & _CURSOR_POSITION:
+                    if self.keyset:
+                        raise ValueError()
+
+                    position, index = _unpack_value(data, index)
+                    position = self._resolve_value(0, position)
+                else:
+                    position = None
+
+                if index != len(data):
+                    raise ValueError()
+            except (TypeError, ValueError, LookupError, StructError, Base64Error):
+                raise NotFound(self.invalid_cursor_message)
+
+            return Cursor(offset=offset, reverse=reverse, position=position)
+
+    def _resolve_value(self, i: int, value: Any) -> Any:
+        """
+        Resolves an enum name read from a cursor to the member of the enum class of the ``i``-th ordering column.
+        """
+        if not isinstance(value, _EnumName):
+            return value
 
-        return Cursor(offset=offset, reverse=reverse, position=position)
+        column = class_mapper(self.model).column_attrs[self.ordering[i]['field']].columns[0]
+        enum_class = getattr(column.type, 'enum_class', None)
+        if enum_class is None:
+            raise ValueError()
+        return enum_class[value]
 
     def encode_cursor(self, cursor: Cursor) -> str:
         """
-        Given a Cursor instance, return an url with encoded cursor.
+        Given a Cursor instance, return the cursor encoded as a compact, url-safe token.
+
+        The token is a binary header with the direction and offset, followed by the type-tagged position values and,
+        when a :attr:`secret_key` is set, a truncated HMAC-SHA256 signature.
         """
-        tokens = {}
-        if cursor.offset != 0:
-            tokens['o'] = str(cursor.offset)
-        if cursor.reverse:
-            tokens['r'] = '1'
-        if cursor.position is not None:
-            tokens['p'] = cursor.position
-
-        querystring = urlencode(tokens, doseq=True)
-        encoded = b64encode(querystring.encode('ascii')).decode('ascii')
-        return encoded
+        with self._timer('cursor_encode'):
+            flags = _CURSOR_REVERSE if cursor.reverse else 0
+            offset = min(cursor.offset, self.offset_cutoff)
+
+            if isinstance(cursor.position, tuple):
+                flags |= _CURSOR_KEYSET
+                data = _pack_header(flags, offset) + bytes([len(cursor.position)]) + \
+                    b''.join(_pack_value(value) for value in cursor.position)
+            elif cursor.position is not None:
+                flags |= _CURSOR_POSITION
+                data = _pack_header(flags, offset) + _pack_value(cursor.position)
+            else:
+                data = _pack_header(flags, offset)
+
+            if self.secret_key is not None:
+                data += self._sign(data)
+
+            return urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+    def _sign(self, data: bytes) -> bytes:
+        return hmac.new(self.secret_key, data, sha256).digest()[:self.signature_size]
 
     def _get_position_from_instance(self, instance, ordering):
         field = ordering[0]['field']
@@ -317,4 +678,9 @@ class CursorPagination(object):
             attr = instance[field]
         else:
             attr = getattr(instance, field)
-        return str(attr)
\ No newline at end of file
+        return attr
+
+    def _get_keyset_position_from_instance(self, instance) -> Tuple[Any, ...]:
+        if isinstance(instance, dict):
+            return tuple(instance[order['field']] for order in self.ordering)
+        return tuple(getattr(instance, order['field']) for order in self.ordering)
@@ -1,18 +1,64 @@
-from typing import Type, Set, Iterable, Any, Mapping, List, Dict
+from itertools import takewhile
+from operator import attrgetter, itemgetter
+from time import monotonic
+from typing import Type, Set, Iterable, Any, Mapping, List, Dict, Sequence, Union, Tuple, Optional, Callable, \
+    Iterator, NamedTuple
 
 from flask import current_app
 from flask_sqlalchemy import get_state
+from sqlalchemy import func, literal_column, select, Table, UniqueConstraint
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import class_mapper
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import class_mapper, load_only
+from sqlalchemy.orm.attributes import instance_state
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.orm.exc import NoResultFound, UnmappedColumnError
+from sqlalchemy.sql.expression import ClauseElement, Executable
 from venom.common import FieldMask
-from venom.exceptions import NotFound, Conflict
+from venom.exceptions import NotFound, Conflict, BadRequest, Error
 from venom.message import fields, items
 from venom.rpc import Service
+from venom.util import cached_property
 
 from venom_resource import Relationship
 from venom_resource.resource import Resource, _Mo, _Mo_id, _M
-from .pagination import _Ordering_T, CursorPagination
+from .filters import FilterCompiler
+from .pagination import _Ordering_T, CursorPagination, Page
+
+
+class _Collection(NamedTuple):
+    """
+    How the ids of a to-many relationship are read without loading the related entities: the rows of ``id_column``
+    whose ``key_column`` matches the ``key_attribute`` of an entity. If ``association`` is true, the columns belong to
+    an association table whose rows can be inserted and deleted directly.
+    """
+    key_attribute: str
+    key_column: 'sqlalchemy.Column'
+    id_column: 'sqlalchemy.Column'
+    association: bool
+
+
+class _Explain(Executable, ClauseElement):
+    """
+    The query plan of ``statement`` as JSON (PostgreSQL), compiled with the bound parameters of the statement.
+    """
+    inherit_cache = False
+
+    def __init__(self, statement) -> None:
+        self.statement = statement
+
+
+@compiles(_Explain)
+def _compile_explain(element: _Explain, compiler, **kwargs) -> str:
+    return f'EXPLAIN (FORMAT JSON) {compiler.process(element.statement, **kwargs)}'
+
+
+def _is_foreign_key_violation(error: IntegrityError) -> bool:
+    # PostgreSQL reports the SQLSTATE, MySQL an error code and SQLite only a message
+    orig = error.orig
+    return getattr(orig, 'pgcode', None) == '23503' \
+        or bool(orig.args) and orig.args[0] == 1452 \
+        or 'FOREIGN KEY constraint failed' in str(orig)
 
 
 class SQLAlchemyResource(Resource[_Mo, _Mo_id, _M]):
@@ -36,11 +82,33 @@ class SQLAlchemyResource(Resource[_Mo, _Mo_id, _M]):
     model_id_type: Type[_Mo_id] = int  # TODO
 
     read_only_field_names: Set[str]
+    column_attribute_names: Set[str]
+    primary_key_attribute_names: Set[str]
+
+    # The attribute names of the columns of each index, which are the orderings that can be sorted using an index.
+    index_orderings: List[Tuple[str, ...]]
 
     request_id_field_name: str
 
     default_page_size: int = 50
     maximum_page_size: int = 100
+    keyset_pagination: bool = False
+    allow_unindexed_ordering: bool = False
+    cursor_secret_key: bytes = None
+
+    batch_chunk_size: int = 500
+    export_chunk_size: int = 1000
+
+    count_cap: int = 10000
+
+    # Counts are only cached when a TTL is set. A cached count is not invalidated by writes and is reported as inexact.
+    count_cache_ttl: float = None
+
+    # How relationship fields are written. By default the related entity is loaded and assigned to the relationship.
+    # With "query" or "constraint", the foreign key of a many-to-one relationship to the id of the related resource is
+    # written directly; "query" checks that the related entities exist with one IN query for all of the ids of a write,
+    # "constraint" leaves it to the foreign key constraint and maps its violations to NotFound.
+    foreign_key_check: str = None
 
     def __init__(self, model: Type[_Mo],
                  model_message: Type[_M],
@@ -50,6 +118,7 @@ class SQLAlchemyResource(Resource[_Mo, _Mo_id, _M]):
                  relationships: Iterable[Relationship] = ()) -> None:
         super().__init__(model, model_message, name=name, model_name=model_name)
         self._inspect_model(model)
+        self._count_cache = {}
 
         self._relationships = {
             r.field_name: r for r in relationships
@@ -73,12 +142,30 @@ class SQLAlchemyResource(Resource[_Mo, _Mo_id, _M]):
         self.model_id_attribute = model_id_column.name
 
         self.read_only_field_names = {self.model_id_attribute}
+        self.column_attribute_names = {prop.key for prop in mapper.column_attrs}
+        self.primary_key_attribute_names = {mapper.get_property_by_column(column).key for column in mapper.primary_key}
         self.default_sort_column = self.model_id_column
         self.default_sort_reverse = False
 
+        primary_key_orderings = tuple(mapper.get_property_by_column(column).key for column in mapper.primary_key)
+        self.index_orderings = [primary_key_orderings]
+
+        table = mapper.local_table
+        unique_constraints = [constraint for constraint in table.constraints if isinstance(constraint, UniqueConstraint)]
+        for index in sorted(table.indexes, key=lambda index: index.name or '') + unique_constraints:
+            ordering = []
+            for column in index.columns:
+                try:
+                    ordering.append(mapper.get_property_by_column(column).key)
+                except UnmappedColumnError:
+                    break
+            if ordering:
+                self.index_orderings.append(tuple(ordering))
+
     @staticmethod
     def _session():
-        # XXX reference to current_app would have to be in context if this wasn't synchronous. Use RequestContext.
+        # NOTE when the resource has an executor, this is called from a worker thread in which the executor has pushed
+        # the application context of the caller.
         return get_state(current_app).db.session
 
     def __set_name__(self, owner, name):
@@ -88,6 +175,18 @@ class SQLAlchemyResource(Resource[_Mo, _Mo_id, _M]):
         if issubclass(owner, Service):
             self.default_page_size = owner.__meta__.get('default_page_size') or self.default_page_size
             self.maximum_page_size = owner.__meta__.get('maximum_page_size') or self.maximum_page_size
+            self.keyset_pagination = owner.__meta__.get('keyset_pagination') or self.keyset_pagination
+            self.allow_unindexed_ordering = owner.__meta__.get('allow_unindexed_ordering') \
+                or self.allow_unindexed_ordering
+            self.cursor_secret_key = owner.__meta__.get('cursor_secret_key') or self.cursor_secret_key
+            self.executor = owner.__meta__.get('executor') or self.executor
+            self.cache = owner.__meta__.get('cache') or self.cache
+            self.version_attribute = owner.__meta__.get('version_attribute') or self.version_attribute
+            self.instrumentation = owner.__meta__.get('instrumentation') or self.instrumentation
+            self.foreign_key_check = owner.__meta__.get('foreign_key_check') or self.foreign_key_check
+            self.count_cap = owner.__meta__.get('count_cap') or self.count_cap
+            if owner.__meta__.get('count_cache_ttl') is not None:
+                self.count_cache_ttl = owner.__meta__.get('count_cache_ttl')
             owner.__meta__.converters += self.entity_converter,
 
         if issubclass(owner, ResourceService):
@@ -96,17 +195,265 @@ class SQLAlchemyResource(Resource[_Mo, _Mo_id, _M]):
     def get_from_message(self, message: _M) -> _Mo:
         return self.get(message[self.request_id_field_name])
 
-    def get(self, id_: _Mo_id, *filters: Any) -> _Mo:
-        try:
-            query = self.model.query
+    def get(self, id_: _Mo_id, *filters: Any, read_mask: FieldMask = None) -> _Mo:
+        query = self._query(read_mask)
 
-            if filters:
-                query = query.filter(*filters)
+        if not filters:
+            # Query.get() returns the entity from the identity map of the session if it has been loaded already.
+            with self._timer('query', 'get'):
+                entity = query.get(id_)
+            if entity is None:
+                raise NotFound()  # TODO custom messages
+            return entity
 
-            return query.filter(self.model_id_column == id_).one()
+        try:
+            with self._timer('query', 'get'):
+                return query.filter(*filters).filter(self.model_id_column == id_).one()
         except NoResultFound as e:
             raise NotFound()  # TODO custom messages
 
+    def get_many(self, ids: Iterable[_Mo_id], read_mask: FieldMask = None) -> Dict[_Mo_id, _Mo]:
+        """
+        Returns a dictionary of the entities with the given ids that exist. Entities already in the identity map of
+        the session are returned from there; the others are loaded using a single ``IN`` query.
+        """
+        mapper = class_mapper(self.model)
+        identity_map = self._session().identity_map
+
+        entities, missing_ids = {}, set()
+        for id_ in ids:
+            entity = identity_map.get(mapper.identity_key_from_primary_key([id_]))
+            if entity is not None and not instance_state(entity).expired:
+                entities[id_] = entity
+            else:
+                missing_ids.add(id_)
+
+        if missing_ids:
+            with self._timer('query', 'get_many'):
+                loaded = self._get_many_by_id(missing_ids, self._query(read_mask))
+            self._observe('rows', len(loaded), 'get_many')
+            entities.update(loaded)
+        return entities
+
+    def attach(self, entities: Dict[_Mo_id, _Mo]) -> Dict[_Mo_id, _Mo]:
+        """
+        Merges entities loaded by the :attr:`executor` into the session of the caller, without querying the database.
+        The session of the worker thread is removed once the call returns, so that changes to the detached entities
+        would otherwise not be written.
+        """
+        if self.executor is None:
+            return entities
+
+        session = self._session()
+        return {id_: session.merge(entity, load=False) for id_, entity in entities.items()}
+
+    def _load_relationships(self, items: Iterable[Mapping[str, Any]], mask: FieldMask = None) -> Dict[str, Any]:
+        """
+        Loads what is needed to write the relationship fields of ``items`` (that match ``mask``) using a single query
+        for each relationship: the entities referenced by each field or, for foreign keys that are written directly
+        and checked with a query (see :attr:`foreign_key_check`) and for association tables, the set of the referenced
+        ids that exist.
+
+        :returns: a dictionary of the entities by id, or of the set of ids, by field name.
+        """
+        loaded = {}
+        for field_name, relationship in self._relationships.items():
+            if mask is not None and not mask.match_path(field_name):
+                continue
+
+            writes_ids = self._writes_foreign_key(field_name) or self._writes_association(field_name)
+            if writes_ids and self.foreign_key_check == 'constraint':
+                continue
+
+            ids = set()
+            for item in items:
+                if field_name in item and item[field_name]:
+                    if field_name in self._collections:
+                        ids.update(item[field_name])
+                    else:
+                        ids.add(item[field_name])
+            if not ids:
+                continue
+
+            resource = self.resolve(relationship.resource)
+            if writes_ids:
+                loaded[field_name] = resource.get_existing_ids(ids)
+            else:
+                loaded[field_name] = resource.get_many(ids)
+        return loaded
+
+    def get_existing_ids(self, ids: Iterable[_Mo_id]) -> Set[_Mo_id]:
+        """
+        Returns the subset of ``ids`` that belong to an entity, using a single ``IN`` query.
+        """
+        query = self._session().query(self.model_id_column).filter(self.model_id_column.in_(list(ids)))
+        return {id_ for id_, in query}
+
+    def _writes_foreign_key(self, field_name: str) -> bool:
+        return self.foreign_key_check is not None and field_name in self._foreign_key_attributes
+
+    def _writes_association(self, field_name: str) -> bool:
+        return field_name in self._collections and self._collections[field_name].association
+
+    @cached_property
+    def _foreign_key_attributes(self) -> Dict[str, str]:
+        """
+        The names of the foreign key attributes of the relationship fields whose foreign key can be written directly:
+        many-to-one relationships through a single column to the id of the related resource.
+        """
+        mapper = class_mapper(self.model)
+        attributes = {}
+
+        for field_name, relationship in self._relationships.items():
+            prop = mapper.get_property(relationship.name)
+            if prop.direction is MANYTOONE and len(prop.local_remote_pairs) == 1:
+                (local_column, remote_column), = prop.local_remote_pairs
+                if remote_column is self.resolve(relationship.resource).model_id_column:
+                    attributes[field_name] = mapper.get_property_by_column(local_column).key
+        return attributes
+
+    @cached_property
+    def _collections(self) -> Dict[str, Optional[_Collection]]:
+        """
+        The to-many relationship fields, each with the :class:`_Collection` through which its ids are read and
+        written, or ``None`` if it can only be read and written through the ORM. That is possible for a many-to-many
+        relationship with an association table that references the id of the related resource, and for a
+        one-to-many relationship through a single foreign key of the related table.
+        """
+        mapper = class_mapper(self.model)
+        collections = {}
+
+        for field_name, relationship in self._relationships.items():
+            prop = mapper.get_property(relationship.name)
+            if not prop.uselist:
+                continue
+
+            collections[field_name] = None
+            resource = self.resolve(relationship.resource)
+
+            if prop.secondary is not None:
+                if isinstance(prop.secondary, Table) \
+                        and len(prop.synchronize_pairs) == 1 and len(prop.secondary_synchronize_pairs) == 1:
+                    (local_column, key_column), = prop.synchronize_pairs
+                    (remote_column, id_column), = prop.secondary_synchronize_pairs
+                    if remote_column is resource.model_id_column:
+                        collections[field_name] = _Collection(mapper.get_property_by_column(local_column).key,
+                                                              key_column, id_column, association=True)
+            elif len(prop.local_remote_pairs) == 1:
+                (local_column, remote_column), = prop.local_remote_pairs
+                if remote_column.table is class_mapper(resource.model).local_table:
+                    collections[field_name] = _Collection(mapper.get_property_by_column(local_column).key,
+                                                          remote_column, resource.model_id_column, association=False)
+        return collections
+
+    def _set_relationship(self, entity: _Mo, field_name: str, value: Any, related: Mapping[str, Any]) -> None:
+        """
+        Sets the relationship of a field to the entity with the id ``value``, or to nothing if the id is empty. For a
+        to-many relationship, ``value`` is a list of ids; if it has an association table, the ids are only checked
+        here and the rows are written by :meth:`_write_associations`.
+
+        :param related: the entities or ids loaded by :meth:`_load_relationships`.
+        :raises NotFound: if there is no entity with the id.
+        """
+        if self._writes_foreign_key(field_name):
+            self._check_related(field_name, [value] if value else [], related)
+            setattr(entity, self._foreign_key_attributes[field_name], value or None)
+        elif self._writes_association(field_name):
+            self._check_related(field_name, value or [], related)
+        elif field_name in self._collections:
+            relationship = self._relationships[field_name]
+            resource = self.resolve(relationship.resource)
+            try:
+                collection = [related[field_name][id_] for id_ in value or []]
+            except KeyError:
+                raise NotFound()
+
+            previous_ids = {resource.format_id(related_entity) for related_entity in getattr(entity, relationship.name)}
+            self._mark_stale(resource, previous_ids.symmetric_difference(value or []))
+            setattr(entity, relationship.name, collection)
+        elif not value:
+            setattr(entity, field_name, None)
+        else:
+            try:
+                setattr(entity, self._relationships[field_name].name, related[field_name][value])
+            except KeyError:
+                raise NotFound()
+
+    @staticmethod
+    def _check_related(field_name: str, ids: Iterable[Any], related: Mapping[str, Any]) -> None:
+        # the ids are not loaded if the database checks them
+        if field_name in related and any(id_ not in related[field_name] for id_ in ids):
+            raise NotFound()
+
+    def _write_associations(self,
+                            entity: Any,
+                            changes: Mapping[str, Any],
+                            mask: FieldMask = None) -> None:
+        """
+        Writes the rows of the association tables of the to-many relationship fields of ``changes`` that match
+        ``mask``. Rather than rewriting the collection through the ORM, the ids that are currently associated with the
+        entity are read with a single query and compared to the new ids, and the difference is written with a bulk
+        ``INSERT`` and a single ``DELETE``.
+
+        :param entity: the entity, which must have been flushed, or a row with its key attributes.
+        :param mask: if not given, the entity is new and only has the rows that are inserted.
+        """
+        session = self._session()
+
+        for field_name, collection in self._collections.items():
+            if collection is None or not collection.association:
+                continue
+            if (not changes.get(field_name)) if mask is None else (not mask.match_path(field_name)):
+                continue
+
+            key = getattr(entity, collection.key_attribute)
+            key_column, id_column = collection.key_column, collection.id_column
+            ids = set(changes.get(field_name) or ())
+
+            if mask is None:
+                current = set()
+            else:
+                current = {id_ for id_, in session.execute(select([id_column]).where(key_column == key))}
+
+            if ids - current:
+                session.execute(key_column.table.insert(), [
+                    {key_column.key: key, id_column.key: id_} for id_ in ids - current
+                ])
+            if current - ids:
+                session.execute(key_column.table.delete()
+                                .where(key_column == key)
+                                .where(id_column.in_(current - ids)))
+
+            self._mark_stale(self.resolve(self._relationships[field_name].resource), ids ^ current)
+
+    def _mark_stale(self, resource: Resource, ids: Iterable[Any]) -> None:
+        """
+        Marks the cached messages of the related entities with the given ids as stale, because the ids of one of
+        their to-many relationships have changed. They are invalidated by :meth:`_commit`.
+        """
+        if ids:
+            self._session().info.setdefault('venom_resource_stale', set()).update((resource, id_) for id_ in ids)
+
+    def _commit(self, session: 'sqlalchemy.orm.Session') -> None:
+        """
+        Commits the session, then invalidates the messages marked as stale by :meth:`_mark_stale`.
+        """
+        session.commit()
+
+        stale = session.info.pop('venom_resource_stale', ())
+        for resource in {resource for resource, _ in stale}:
+            resource.invalidate(*(id_ for stale_resource, id_ in stale if stale_resource is resource))
+
+    def _integrity_error(self, error: IntegrityError, delete: bool = False) -> Error:
+        """
+        Returns the error for an integrity error: :class:`NotFound` for a foreign key violation of a write if
+        :attr:`foreign_key_check` is ``"constraint"``, :class:`Conflict` otherwise. A foreign key violation of a
+        ``delete`` means that the entity is still referenced, which is a conflict.
+        """
+        if not delete and self.foreign_key_check == 'constraint' and _is_foreign_key_violation(error):
+            return NotFound()
+        return Conflict()
+
     # TODO return a proxy object for paginate(), create() etc.
     # def __get__(self, instance, owner):
 
@@ -117,11 +464,147 @@ class SQLAlchemyResource(Resource[_Mo, _Mo_id, _M]):
             except (IndexError, TypeError, KeyError):
                 return getattr(entity, self.model_id_attribute)
 
+    def parse_ordering(self, order: Sequence[Any]) -> List[Dict[str, Any]]:
+        """
+        Converts the ``order`` of a list request to an ordering for :meth:`paginate`. Each item is either a field
+        name, prefixed with ``-`` for descending order, or an object such as ``{"field": "name", "ascending": false}``.
+
+        The fields must be column fields of the model message and, unless :attr:`allow_unindexed_ordering` is set,
+        the leading columns of an index (see :attr:`index_orderings`). The primary key is appended to the ordering as
+        a tiebreaker. With :attr:`keyset_pagination`, the fields must not be nullable, because rows with null values
+        cannot be compared to the position of a page and would be skipped. :attr:`order_json_schema` lists the same
+        fields.
+        """
+        orderable_field_names = self._orderable_field_names
+        ordering = []
+        for item in order:
+            if isinstance(item, str):
+                ascending = not item.startswith('-')
+                field_name = item if ascending else item[1:]
+            elif isinstance(item, Mapping):
+                field_name, ascending = item.get('field'), item.get('ascending', True)
+            else:
+                raise BadRequest(f'Invalid order: {item!r}')
+
+            if field_name not in orderable_field_names:
+                if field_name in self._message_column_names:
+                    raise BadRequest(f'Unable to order by "{field_name}", which is nullable, with keyset pagination')
+                raise BadRequest(f'Unable to order by "{field_name}"')
+
+            ordering.append({'field': field_name, 'ascending': bool(ascending)})
+
+        if not ordering:
+            return ordering
+
+        field_names = tuple(order['field'] for order in ordering)
+        if not self.allow_unindexed_ordering and not self._is_indexed_ordering(field_names):
+            raise BadRequest(f'Unable to order by "{", ".join(field_names)}" without an index')
+
+        for field_name in self.index_orderings[0]:
+            if field_name not in field_names:
+                ordering.append({'field': field_name, 'ascending': ordering[-1]['ascending']})
+        return ordering
+
+    @cached_property
+    def _nullable_attribute_names(self) -> Set[str]:
+        mapper = class_mapper(self.model)
+        return {prop.key for prop in mapper.column_attrs if any(column.nullable for column in prop.columns)}
+
+    @cached_property
+    def _message_column_names(self) -> Set[str]:
+        # the columns that are exposed as fields of the model message; hidden columns must not be filtered or ordered
+        # by, since that would reveal their values
+        return {field.name for field in fields(self.model_message)
+                if field.name in self.column_attribute_names and field.name not in self._relationships}
+
+    @property
+    def _orderable_field_names(self) -> Set[str]:
+        if self.keyset_pagination:
+            return self._message_column_names - self._nullable_attribute_names
+        return self._message_column_names
+
+    def _is_indexed_ordering(self, field_names: Tuple[str, ...]) -> bool:
+        # primary key columns at the end of the ordering are a tiebreaker and need not be part of the index
+        while field_names and field_names[-1] in self.primary_key_attribute_names:
+            field_names = field_names[:-1]
+
+        return not field_names or any(index[:len(field_names)] == field_names for index in self.index_orderings)
+
+    @cached_property
+    def order_json_schema(self) -> Dict[str, Any]:
+        """
+        A JSON schema of the order of a list request, which lists the field names that can be ordered by. The
+        orderings supported by an index, with the primary key tiebreaker, are listed under ``x-orderings``.
+        """
+        orderable_field_names = self._orderable_field_names
+
+        # the leading columns of each index that can be ordered by, which are the orderings parse_ordering() accepts
+        index_orderings = []
+        for index in self.index_orderings:
+            ordering = tuple(takewhile(orderable_field_names.__contains__, index))
+            if ordering and ordering not in index_orderings:
+                index_orderings.append(ordering)
+
+        if self.allow_unindexed_ordering:
+            field_names = orderable_field_names
+        else:
+            field_names = {field_name for index in index_orderings for field_name in index}
+        field_names = sorted(field_names)
+
+        tiebreaker = self.index_orderings[0]
+        return {
+            'type': 'array',
+            'items': {
+                'anyOf': [
+                    {'enum': field_names + [f'-{field_name}' for field_name in field_names]},
+                    {
+                        'type': 'object',
+                        'properties': {
+                            'field': {'enum': field_names},
+                            'ascending': {'type': 'boolean'}
+                        },
+                        'required': ['field'],
+                        'additionalProperties': False
+                    }
+                ]
+            },
+            'x-orderings': [list(index) + [name for name in tiebreaker if name not in index]
+                            for index in index_orderings]
+        }
+
+    def parse_filters(self, filters: Mapping[str, Any]) -> List[Any]:
+        """
+        Converts the ``filters`` of a list request to SQLAlchemy expressions for :meth:`paginate`. See
+        :class:`FilterCompiler` for the filter language.
+        """
+        return self._filter_compiler.compile(filters)
+
+    @cached_property
+    def _filter_compiler(self) -> FilterCompiler:
+        return FilterCompiler(self)
+
+    @cached_property
+    def filter_json_schema(self) -> Dict[str, Any]:
+        return self._filter_compiler.json_schema()
+
     def paginate(self,
-                 page_size: int = 50,
+                 page_size: int = None,
                  page_token: str = '',
                  ordering: _Ordering_T = None,
-                 filters: List[Any] = None) -> Dict[str, Any]:
+                 filters: List[Any] = None,
+                 read_mask: FieldMask = None,
+                 count_mode: str = None) -> Page:
+        """
+        Returns a :class:`Page` with the ``items`` of the page and the ``next_page_token`` and
+        ``previous_page_token``, which are only encoded when they are looked up.
+
+        :param count_mode: if set, the result includes a ``total_count`` of the matching entities and whether that
+            count is exact, see :meth:`count`.
+        """
+        if page_size is not None and page_size < 0:
+            raise BadRequest('Invalid page size')
+
+        page_size = min(page_size or self.default_page_size, self.maximum_page_size)
 
         if not ordering:
             if self.default_sort_reverse:
@@ -135,87 +618,703 @@ class SQLAlchemyResource(Resource[_Mo, _Mo_id, _M]):
                     'ascending': True
                 }
 
-        query = self.model.query
+        pagination = CursorPagination(self.model,
+                                      page_size,
+                                      ordering,
+                                      keyset=self.keyset_pagination,
+                                      secret_key=self.cursor_secret_key,
+                                      instrumentation=self.instrumentation,
+                                      resource_name=self.model_name)
+
+        # the ordering columns are needed to compute the cursor positions
+        query = self._query(read_mask, [order['field'] for order in pagination.ordering])
 
         if filters:
             query = query.filter(*filters)
 
-        pagination = CursorPagination(self.model, page_size, ordering)
-        items = pagination.paginate_query(query, page_token)
-        next_token = pagination.get_next_token()
-        previous_token = pagination.get_previous_token()
+        pagination.paginate_query(query, page_token)
 
-        return {
-            'items': items,
-            'next_page_token': next_token,
-            'previous_page_token': previous_token
-        }
+        if count_mode:
+            total_count, total_count_exact = self.count(filters, count_mode)
+            return Page(pagination, total_count=total_count, total_count_exact=total_count_exact)
+        return Page(pagination)
+
+    def count(self, filters: List[Any] = None, mode: str = 'exact') -> Tuple[int, bool]:
+        """
+        Counts the entities that match ``filters``.
+
+        ``"exact"`` counts every row. ``"capped"`` stops counting after :attr:`count_cap` rows. ``"estimate"`` uses
+        the row estimate of the query planner where the database provides one (PostgreSQL) and otherwise falls back
+        to a capped count.
+
+        If :attr:`count_cache_ttl` is set, counts are cached for each mode and set of filters for that many seconds.
+        Since a cached count may be stale, it is returned as inexact.
+
+        :returns: a ``(count, exact)`` tuple.
+        """
+        if mode not in ('exact', 'capped', 'estimate'):
+            raise BadRequest(f'Invalid count mode: "{mode}"')
+
+        session = self._session()
+        query = session.query(literal_column('1')).select_from(self.model)
+
+        if filters:
+            query = query.filter(*filters)
+
+        mapper = class_mapper(self.model)
+        dialect = session.connection(mapper=mapper).dialect
+        key = None
+
+        if self.count_cache_ttl:
+            statement = query.statement.compile(dialect=dialect)
+            # the values of expanding parameters, such as those of IN filters, are lists
+            params = [(name, tuple(value) if isinstance(value, list) else value)
+                      for name, value in sorted(statement.params.items(), key=itemgetter(0))]
+            key = (mode, str(statement), tuple(params))
+
+            try:
+                expires, (count, _) = self._count_cache[key]
+                if expires > monotonic():
+                    return count, False
+            except (KeyError, TypeError):
+                pass
+
+        with self._timer('query', 'count'):
+            if mode == 'estimate' and dialect.name == 'postgresql':
+                plan = session.execute(_Explain(query.statement), mapper=mapper).scalar()
+                result = int(plan[0]['Plan']['Plan Rows']), False
+            elif mode == 'exact':
+                result = session.query(func.count()).select_from(query.subquery()).scalar(), True
+            else:
+                count = session.query(func.count()).select_from(query.limit(self.count_cap + 1).subquery()).scalar()
+                result = min(count, self.count_cap), count <= self.count_cap
+
+        if key is not None:
+            if len(self._count_cache) >= 1024:
+                self._count_cache.clear()
+            try:
+                self._count_cache[key] = monotonic() + self.count_cache_ttl, result
+            except TypeError:  # unhashable parameters
+                pass
+
+        return result
+
+    def export(self, filters: List[Any] = None, read_mask: FieldMask = None) -> Iterator[List[_M]]:
+        """
+        Yields the formatted messages of every entity that matches ``filters`` in chunks of
+        :attr:`export_chunk_size`, in primary key order.
+
+        The rows are read with ``yield_per()``, which uses a server-side cursor where the database driver supports
+        one. Each chunk is formatted at once and then expunged from the session, so that memory use does not grow with
+        the number of rows.
+        """
+        session = self._session()
+        query = self._query(read_mask)
+
+        if filters:
+            query = query.filter(*filters)
+
+        query = query.order_by(*class_mapper(self.model).primary_key).yield_per(self.export_chunk_size)
+
+        chunk, rows = [], 0
+        for entity in query:
+            chunk.append(entity)
+            if len(chunk) == self.export_chunk_size:
+                rows += len(chunk)
+                yield self._format_export_chunk(session, chunk, read_mask)
+                chunk = []
+
+        if chunk:
+            rows += len(chunk)
+            yield self._format_export_chunk(session, chunk, read_mask)
+
+        self._observe('rows', rows, 'export')
+
+    def _format_export_chunk(self, session, entities: List[_Mo], read_mask: FieldMask = None) -> List[_M]:
+        with self._timer('format', 'export'):
+            messages = self.format_many(entities, read_mask)
+        for entity in entities:
+            session.expunge(entity)
+        return messages
+
+    def _query(self, read_mask: FieldMask = None, attribute_names: Iterable[str] = ()) -> 'sqlalchemy.orm.Query':
+        """
+        Returns a query for the model that only loads the columns needed to format the fields in ``read_mask`` (or
+        all fields) of the model message, as well as any additional ``attribute_names``.
+        """
+        if self._projection is None:
+            return self.model.query
+
+        names = set(self.primary_key_attribute_names).union(attribute_names)
+        if self.version_attribute:
+            names.add(self.version_attribute)
+
+        for field_name, field_attribute_names in self._projection.items():
+            if read_mask is None or read_mask.match_path(field_name):
+                names.update(field_attribute_names)
+        return self.model.query.options(load_only(*names))
+
+    @cached_property
+    def _projection(self) -> Optional[Dict[str, Set[str]]]:
+        """
+        The names of the column attributes needed to format each field of the model message. ``None`` if the message
+        has fields that are not mapped to a column or relationship, such as properties, in which case entities are
+        loaded in full.
+        """
+        mapper = class_mapper(self.model)
+        projection = {}
+
+        for field in fields(self.model_message):
+            if field.name in self._relationships:
+                prop = mapper.get_property(self._relationships[field.name].name)
+                projection[field.name] = {mapper.get_property_by_column(column).key for column in prop.local_columns}
+            elif field.name in self.column_attribute_names:
+                projection[field.name] = {field.name}
+            else:
+                return None
+        return projection
 
     def create(self, properties: _M) -> _Mo:
-        entity = self.model()
         session = self._session()
 
         try:
-            for name, value in items(properties):
-                if name not in self.read_only_field_names:
-                    if name in self._relationships:
-                        relationship = self._relationships[name]
-                        resource = self.resolve(relationship.resource)
-                        setattr(entity, relationship.name, resource.get(value))
-                    else:
-                        setattr(entity, name, value)
+            entity = self._create_entity(properties)
+            self._commit(session)
+        except IntegrityError as e:
+            session.rollback()
+            raise self._integrity_error(e)
+
+        return entity
+
+    def create_message(self, properties: _M) -> _M:
+        """
+        Creates an entity and returns its formatted model message.
+
+        The message is formatted after the entity is flushed and before the commit expires it, so that it is
+        formatted from the values that were just written rather than by reloading the row. Attributes that the
+        database generates, such as server defaults, are fetched with the ``INSERT`` if the mapper has
+        ``eager_defaults`` and the database supports ``RETURNING``, and otherwise read with a single ``SELECT``.
+        """
+        session = self._session()
+
+        try:
+            entity = self._create_entity(properties)
+            session.flush()
 
-            session.add(entity)
-            session.commit()
+            with self._timer('format', 'create'):
+                message = self.format(entity)
+
+            self._commit(session)
         except IntegrityError as e:
             session.rollback()
-            raise Conflict()
+            raise self._integrity_error(e)
+
+        return message
+
+    def _create_entity(self, properties: _M, related: Mapping[str, Any] = None) -> _Mo:
+        """
+        Creates an entity and adds it to the session. If it has any association table rows, the entity is flushed
+        so that they can be inserted.
+        """
+        if related is None:
+            related = self._load_relationships([properties])
+
+        entity = self.model()
+        for name, value in items(properties):
+            if name not in self.read_only_field_names:
+                if name in self._relationships:
+                    self._set_relationship(entity, name, value, related)
+                else:
+                    setattr(entity, name, value)
+
+        session = self._session()
+        session.add(entity)
 
+        if any(self._writes_association(name) and properties.get(name) for name in self._relationships):
+            session.flush()
+            self._write_associations(entity, properties)
         return entity
 
     def update(self, entity: _Mo, changes: Mapping[str, Any], mask: FieldMask) -> _Mo:
         session = self._session()
+        # NOTE the id is read before the commit expires the entity, which would otherwise be refreshed to read it.
+        id_ = self.format_id(entity)
 
         try:
-            for field in fields(self.model_message):
-                if not mask.match_path(field.name):
-                    continue
-
-                if field.name not in self.read_only_field_names:
-                    if field.name in self._relationships:
-                        # TODO ToMany relationships
-                        if changes.get(field.name):
-                            relationship = self._relationships[field.name]
-                            resource = self.resolve(relationship.resource)
-                            setattr(entity, relationship.name, resource.get(changes.get(field.name)))
-                        else:
-                            setattr(entity, field.name, None)
-                    else:
-                        setattr(entity, field.name, changes.get(field.name))
-            session.commit()
+            self._update_entity(entity, changes, mask)
+            self._commit(session)
         except IntegrityError as e:
             session.rollback()
-            raise Conflict()
+            raise self._integrity_error(e)
 
+        self.invalidate(id_)
         return entity
 
+    def update_by_id(self, id_: _Mo_id, changes: Mapping[str, Any], mask: FieldMask) -> _M:
+        """
+        Updates the entity with the given id and returns its formatted model message.
+
+        Unless the mask includes a relationship other than a foreign key that is written directly (see
+        :attr:`foreign_key_check`) or an association table keyed by the id, the changes are written with a single
+        ``UPDATE`` statement without loading the entity first. The message is formatted from the updated row, which is
+        returned by the statement where the database supports ``RETURNING`` and read with a second statement
+        otherwise. Entities are still updated through the session if the mapper has validators, a version counter or
+        update events. The rows of association tables are written as in :meth:`_write_associations`.
+
+        :raises NotFound: if no row has the given id.
+        """
+        columns = self._update_columns
+        if columns is None or any(mask.match_path(name) and not self._writes_foreign_key(name)
+                                  and not self._writes_association_by_id(name)
+                                  for name in self._relationships):
+            return super().update_by_id(id_, changes, mask)
+
+        related = self._load_relationships([changes], mask)
+        values = {}
+
+        for field in fields(self.model_message):
+            if field.name in self.read_only_field_names or not mask.match_path(field.name):
+                continue
+
+            if field.name in self._collections:
+                self._check_related(field.name, changes.get(field.name) or [], related)
+            elif field.name in self._relationships:
+                value = changes.get(field.name)
+                self._check_related(field.name, [value] if value else [], related)
+                values[columns[self._foreign_key_attributes[field.name]]] = value or None
+            else:
+                values[columns[field.name]] = changes.get(field.name)
+
+        session = self._session()
+        mapper = class_mapper(self.model)
+        selected = [column.label(name) for name, column in sorted(columns.items())]
+        where = self.model_id_column == id_
+
+        try:
+            with self._timer('query', 'update'):
+                if not values:
+                    row = session.execute(select(selected).where(where), mapper=mapper).first()
+                elif session.connection(mapper=mapper).dialect.implicit_returning:
+                    statement = mapper.local_table.update().where(where).values(values)
+                    row = session.execute(statement.returning(*selected), mapper=mapper).first()
+                else:
+                    statement = mapper.local_table.update().where(where).values(values)
+                    if session.execute(statement, mapper=mapper).rowcount:
+                        row = session.execute(select(selected).where(where), mapper=mapper).first()
+                    else:
+                        row = None
+
+                if row is not None:
+                    self._write_associations(row, changes, mask)
+                self._commit(session)
+        except IntegrityError as e:
+            session.rollback()
+            raise self._integrity_error(e)
+
+        if row is None:
+            raise NotFound()
+
+        self.invalidate(id_)
+        return self.format(row)
+
+    def _writes_association_by_id(self, field_name: str) -> bool:
+        return self._writes_association(field_name) \
+            and self._collections[field_name].key_attribute == self.model_id_attribute
+
+    @cached_property
+    def _update_columns(self) -> Optional[Dict[str, 'sqlalchemy.Column']]:
+        """
+        The columns needed to format the model message by attribute name, which :meth:`update_by_id` updates and reads
+        without going through the session. ``None`` if entities must be updated through the session: if the mapper
+        has validators, a version counter or update events, or if the message has fields that are not mapped to a
+        column of the table, to a relationship with a single foreign key or to a to-many relationship whose ids can
+        be read without the ORM.
+        """
+        mapper = class_mapper(self.model)
+
+        if self._projection is None or mapper.validators or mapper.version_id_col is not None \
+                or len(mapper.tables) != 1 or mapper.dispatch.before_update or mapper.dispatch.after_update:
+            return None
+
+        for field_name, relationship in self._relationships.items():
+            if field_name in self._collections:
+                if self._collections[field_name] is None:
+                    return None
+            elif len(mapper.get_property(relationship.name).local_remote_pairs) != 1:
+                return None
+
+        columns = {}
+        for name in self.primary_key_attribute_names.union(*self._projection.values()):
+            column = mapper.get_property(name).columns[0]
+            if getattr(column, 'table', None) is not mapper.local_table:
+                return None
+            columns[name] = column
+        return columns
+
+    def _update_entity(self,
+                       entity: _Mo,
+                       changes: Mapping[str, Any],
+                       mask: FieldMask,
+                       related: Mapping[str, Any] = None) -> None:
+        if related is None:
+            related = self._load_relationships([changes], mask)
+
+        for field in fields(self.model_message):
+            if not mask.match_path(field.name):
+                continue
+
+            if field.name not in self.read_only_field_names:
+                if field.name in self._relationships:
+                    self._set_relationship(entity, field.name, changes.get(field.name), related)
+                else:
+                    setattr(entity, field.name, changes.get(field.name))
+
+        self._write_associations(entity, changes, mask)
+
+    def batch_get(self, ids: Sequence[_Mo_id], read_mask: FieldMask = None) -> List[Union[_Mo, Error]]:
+        """
+        Loads the entities with the given ids using a single ``IN`` query.
+
+        :returns: a list with either the entity or a :class:`NotFound` error for each id, in the order of ``ids``.
+        """
+        entities = self.get_many(set(ids), read_mask)
+        return [entities[id_] if id_ in entities else NotFound() for id_ in ids]
+
+    def batch_create(self, properties: Sequence[_M]) -> List[Union[_Mo, Error]]:
+        """
+        Creates an entity for each item of ``properties`` in a single transaction.
+
+        :returns: a list with either the created entity or the error raised for each item, in the order of
+            ``properties``.
+        """
+        return self._write_batch(self._batch_create_operations(properties))
+
+    def batch_create_messages(self, properties: Sequence[_M]) -> List[Union[_M, Error]]:
+        """
+        Creates entities as :meth:`batch_create` does and formats them before the commit expires them, as
+        :meth:`create_message` does.
+        """
+        return self._write_batch(self._batch_create_operations(properties), formatted=True)
+
+    def _batch_create_operations(self, properties: Sequence[_M]) -> List[Callable[[], _Mo]]:
+        related = self._load_relationships(properties)
+
+        def create(item):
+            def operation():
+                return self._create_entity(item, related)
+            return operation
+
+        return [create(item) for item in properties]
+
+    def batch_update(self, changes: Sequence[Tuple[_Mo_id, Mapping[str, Any], FieldMask]]) -> List[Union[_Mo, Error]]:
+        """
+        Applies a list of ``(id, changes, mask)`` updates in a single transaction. The entities are loaded using a
+        single ``IN`` query.
+
+        :returns: a list with either the updated entity or the error raised for each update, in the order of
+            ``changes``.
+        """
+        results = self._write_batch(self._batch_update_operations(changes))
+        self.invalidate(*(id_ for (id_, _, _), result in zip(changes, results) if not isinstance(result, Error)))
+        return results
+
+    def batch_update_messages(self,
+                              changes: Sequence[Tuple[_Mo_id, Mapping[str, Any], FieldMask]]) -> List[Union[_M, Error]]:
+        """
+        Updates entities as :meth:`batch_update` does and formats them before the commit expires them.
+        """
+        results = self._write_batch(self._batch_update_operations(changes), formatted=True)
+        self.invalidate(*(id_ for (id_, _, _), result in zip(changes, results) if not isinstance(result, Error)))
+        return results
+
+    def _batch_update_operations(self,
+                                 changes: Sequence[Tuple[_Mo_id, Mapping[str, Any], FieldMask]]) \
+            -> List[Callable[[], _Mo]]:
+        session = self._session()
+        entities = self._get_many_by_id({id_ for id_, _, _ in changes})
+        related = self._load_relationships([item for _, item, _ in changes])
+
+        def update(id_, item, mask):
+            def operation():
+                try:
+                    entity = entities[id_]
+                except KeyError:
+                    raise NotFound()
+
+                try:
+                    self._update_entity(entity, item, mask, related)
+                except Error:
+                    # discard any changes made before the error
+                    session.expire(entity)
+                    raise
+                return entity
+            return operation
+
+        return [update(*change) for change in changes]
+
+    def batch_delete(self, ids: Sequence[_Mo_id]) -> List[Optional[Error]]:
+        """
+        Deletes the entities with the given ids in a single transaction. The entities are loaded using a single ``IN``
+        query.
+
+        :returns: a list with either ``None`` or the error raised for each id, in the order of ``ids``.
+        """
+        session = self._session()
+        entities = self._get_many_by_id(set(ids))
+
+        def delete(id_):
+            def operation():
+                try:
+                    session.delete(entities[id_])
+                except KeyError:
+                    raise NotFound()
+            return operation
+
+        results = self._write_batch([delete(id_) for id_ in ids], delete=True)
+        self.invalidate(*(id_ for id_, result in zip(ids, results) if result is None))
+        return results
+
+    def _get_many_by_id(self, ids: Iterable[_Mo_id], query: 'sqlalchemy.orm.Query' = None) -> Dict[_Mo_id, _Mo]:
+        ids = list(ids)
+        if not ids:
+            return {}
+        if query is None:
+            query = self.model.query
+        return {self.format_id(entity): entity for entity in query.filter(self.model_id_column.in_(ids))}
+
+    def _write_batch(self,
+                     operations: Sequence[Callable[[], Any]],
+                     formatted: bool = False,
+                     delete: bool = False) -> List[Any]:
+        """
+        Runs each write operation in a single transaction, flushing every :attr:`batch_chunk_size` operations. Every
+        chunk is flushed within a savepoint; if the flush fails, the chunk is replayed one operation at a time so that
+        the failing operations can be reported individually while the others are kept.
+
+        :param formatted: if true, the entities returned by the operations are formatted before the commit expires
+            them, which would otherwise reload each of them with a query of its own.
+        :param delete: if true, the operations are deletions (see :meth:`_integrity_error`).
+        """
+        session = self._session()
+        results = [None] * len(operations)
+
+        def run(index):
+            try:
+                results[index] = operations[index]()
+            except Error as e:
+                results[index] = e
+
+        try:
+            for start in range(0, len(operations), self.batch_chunk_size):
+                chunk = range(start, min(start + self.batch_chunk_size, len(operations)))
+
+                try:
+                    with session.begin_nested():
+                        for index in chunk:
+                            run(index)
+                except IntegrityError:
+                    for index in chunk:
+                        try:
+                            with session.begin_nested():
+                                run(index)
+                        except IntegrityError as e:
+                            results[index] = self._integrity_error(e, delete)
+
+            if formatted:
+                with self._timer('format', 'batch'):
+                    results = self.format_results(results)
+            self._commit(session)
+        except:
+            session.rollback()
+            raise
+
+        return results
+
     def delete(self, entity: _Mo) -> None:
         session = self._session()
+        id_ = self.format_id(entity)
         session.delete(entity)
         session.commit()
+        self.invalidate(id_)
+
+    def delete_by_id(self, id_: _Mo_id) -> None:
+        """
+        Deletes the entity with the given id using a single ``DELETE`` statement, without loading the entity first.
+        The entity is deleted through the session instead if the mapper has relationships that the ORM cascades the
+        deletion to, or delete events.
+
+        :raises NotFound: if no row has the given id.
+        """
+        if self._orm_delete_required:
+            return super().delete_by_id(id_)
+
+        session = self._session()
+        mapper = class_mapper(self.model)
+
+        try:
+            with self._timer('query', 'delete'):
+                result = session.execute(mapper.local_table.delete().where(self.model_id_column == id_))
+                session.commit()
+        except IntegrityError as e:
+            session.rollback()
+            raise self._integrity_error(e, delete=True)
+
+        if not result.rowcount:
+            raise NotFound()
+
+        entity = session.identity_map.get(mapper.identity_key_from_primary_key([id_]))
+        if entity is not None:
+            session.expunge(entity)
+
+        self.invalidate(id_)
+
+    @cached_property
+    def _orm_delete_required(self) -> bool:
+        """
+        Whether entities must be deleted through the session: if a relationship cascades the deletion or, unless it
+        has ``passive_deletes``, is a collection whose rows the ORM deletes or orphans; if the mapper has delete events;
+        or if the model spans several tables.
+        """
+        mapper = class_mapper(self.model)
+
+        if len(mapper.tables) != 1 or mapper.dispatch.before_delete or mapper.dispatch.after_delete:
+            return True
+
+        return any(prop.cascade.delete or (prop.direction is not MANYTOONE and not prop.passive_deletes)
+                   for prop in mapper.relationships)
 
     def format(self, entity: _Mo) -> _M:
-        message = self.model_message()
+        return self.format_many([entity])[0]
+
+    def format_many(self, entities: Sequence[_Mo], read_mask: FieldMask = None) -> List[_M]:
+        """
+        Formats a sequence of entities, such as a page of results, resolving the ids of each relationship for all of
+        the entities at once rather than loading the related entity of each row individually.
+
+        :param read_mask: if given, only the fields matching the mask are formatted.
+        """
+        entities = list(entities)
+        attributes, relationships = self._formatter
+
+        if read_mask is not None:
+            attributes = [(name, getter) for name, getter in attributes if read_mask.match_path(name)]
+            relationships = [(name, get_ids) for name, get_ids in relationships if read_mask.match_path(name)]
+
+        relationship_ids = [(name, get_ids(entities)) for name, get_ids in relationships]
+        model_message = self.model_message
+
+        messages = []
+        for index, entity in enumerate(entities):
+            message = model_message()
+            for name, get_attribute in attributes:
+                value = get_attribute(entity)
+                if value is not None:
+                    message[name] = value
+            for name, ids in relationship_ids:
+                if ids[index] is not None:
+                    message[name] = ids[index]
+            messages.append(message)
+        return messages
+
+    @cached_property
+    def _formatter(self) -> Tuple[List[Tuple[str, Callable[[_Mo], Any]]],
+                                  List[Tuple[str, Callable[[List[_Mo]], List[Any]]]]]:
+        """
+        The attribute getters and relationship id loaders used by :meth:`format_many`, one for each field of the
+        model message. These are compiled on first use, when all the related resources have been registered.
+        """
+        attributes, relationships = [], []
         for field in fields(self.model_message):
             if field.name in self._relationships:
-                relationship = self._relationships[field.name]
-                resource = self.resolve(relationship.resource)
-                relationship_entity = getattr(entity, relationship.name)
-                if relationship_entity is not None:
-                    message[field.name] = resource.format_id(relationship_entity)
+                relationships.append((field.name, self._compile_relationship_ids(self._relationships[field.name])))
             else:
-                message[field.name] = getattr(entity, field.name)
-        return message
+                attributes.append((field.name, attrgetter(field.name)))
+        return attributes, relationships
+
+    def _compile_relationship_ids(self, relationship: Relationship) -> Callable[[List[_Mo]], List[Any]]:
+        """
+        Returns a function that returns the ids of the entities referenced by a to-one relationship, in the order of
+        the entities passed to it.
+
+        When the relationship is a foreign key to the primary key of the related resource, the ids are read from the
+        foreign key column and no query is needed. Otherwise the related entities are loaded using a single ``IN``
+        query for all of the entities. To-many relationships are handled by :meth:`_compile_collection_ids`.
+        """
+        if relationship.field_name in self._collections:
+            return self._compile_collection_ids(relationship)
+
+        resource = self.resolve(relationship.resource)
+        mapper = class_mapper(self.model)
+        prop = mapper.get_property(relationship.name)
+
+        if len(prop.local_remote_pairs) != 1:
+            get_related = attrgetter(relationship.name)
+
+            def get_ids(entities):
+                related_entities = [get_related(entity) for entity in entities]
+                return [resource.format_id(related) if related is not None else None for related in related_entities]
+            return get_ids
+
+        (local_column, remote_column), = prop.local_remote_pairs
+        get_key = attrgetter(mapper.get_property_by_column(local_column).key)
+
+        if prop.direction is MANYTOONE and remote_column is resource.model_id_column:
+            def get_ids(entities):
+                return [get_key(entity) for entity in entities]
+            return get_ids
+
+        remote_attribute = prop.mapper.get_property_by_column(remote_column).key
+        remote_column_attribute = getattr(resource.model, remote_attribute)
+        get_remote_key = attrgetter(remote_attribute)
+
+        def get_ids(entities):
+            keys = [get_key(entity) for entity in entities]
+            unique_keys = {key for key in keys if key is not None}
+
+            if not unique_keys:
+                return [None] * len(keys)
+
+            query = resource.model.query \
+                .options(load_only(remote_attribute, resource.model_id_attribute)) \
+                .filter(remote_column_attribute.in_(unique_keys))
+            related_ids = {get_remote_key(related): resource.format_id(related) for related in query}
+            return [related_ids.get(key) for key in keys]
+        return get_ids
+
+    def _compile_collection_ids(self, relationship: Relationship) -> Callable[[List[_Mo]], List[List[Any]]]:
+        """
+        Returns a function that returns the lists of ids of the entities referenced by a to-many relationship, in the
+        order of the entities passed to it.
+
+        The ids are read from the association table, or from the foreign key of the related table, using a single
+        ``IN`` query for all of the entities. Otherwise the collection of each entity is loaded through the ORM.
+        """
+        resource = self.resolve(relationship.resource)
+        collection = self._collections[relationship.field_name]
+
+        if collection is None:
+            get_related = attrgetter(relationship.name)
+
+            def get_ids(entities):
+                return [[resource.format_id(related) for related in get_related(entity)] for entity in entities]
+            return get_ids
+
+        get_key = attrgetter(collection.key_attribute)
+        key_column, id_column = collection.key_column, collection.id_column
+
+        def get_ids(entities):
+            keys = [get_key(entity) for entity in entities]
+            unique_keys = {key for key in keys if key is not None}
+            related_ids = {}
+
+            if unique_keys:
+                query = select([key_column, id_column]) \
+                    .where(key_column.in_(unique_keys)) \
+                    .order_by(key_column, id_column)
+                for key, id_ in self._session().execute(query):
+                    related_ids.setdefault(key, []).append(id_)
+            return [related_ids.get(key, []) for key in keys]
+        return get_ids
 
     def format_id(self, entity: _Mo) -> _Mo_id:
         return getattr(entity, self.model_id_attribute)
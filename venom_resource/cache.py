@@ -0,0 +1,87 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Any, Hashable, Optional
+
+
+class Cache(object):
+    """
+    The interface of the read-through cache of a resource, which stores formatted model messages and their entity tags
+    keyed by ``(model name, message name, id)``. A backend for a shared cache implements these methods and is
+    responsible for serializing keys and values.
+
+    Writes invalidate the messages of the entities they change, including the to-many ids of related entities that
+    change when the rows of an association table or the collection of a one-to-many relationship are written. A
+    message is not invalidated when one of its to-many ids changes because the foreign key of the related entity is
+    written through the related resource, or because the related entity is deleted; use a ``ttl`` if such messages
+    are cached.
+    """
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        raise NotImplementedError
+
+    def set(self, key: Hashable, value: Any) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: Hashable) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+
+class LRUCache(Cache):
+    """
+    An in-process cache that evicts the least recently used entry once it holds ``maxsize`` entries. If ``ttl`` is
+    set, entries expire that many seconds after they were stored.
+
+    ::
+
+        class PetService(DynamicResourceService):
+            __resource__ = SQLAlchemyResource(Pet, PetMessage)
+
+            class Meta:
+                cache = LRUCache(maxsize=10000, ttl=60)
+
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                return None
+
+            if expires is not None and expires <= monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        expires = monotonic() + self.ttl if self.ttl else None
+
+        with self._lock:
+            self._entries[key] = expires, value
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
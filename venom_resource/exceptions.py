@@ -0,0 +1,13 @@
+from venom.exceptions import Error
+
+
+class NotModified(Error):
+    """
+    Raised when the entity tag of a response matches the ``If-None-Match`` header of a request.
+    """
+    http_status = 304
+    description = 'Not Modified'
+
+    def __init__(self, tag: str = None) -> None:
+        super().__init__()
+        self.tag = tag
@@ -0,0 +1,144 @@
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+from typing import Any, Dict, List, Sequence, Tuple
+
+
+class Instrumentation(object):
+    """
+    The interface through which resources and :class:`CursorPagination` report on their hot paths. Every observation
+    has a metric, a value, the name of the resource and the operation --- such as ``"get"``, ``"list"`` or
+    ``"count"`` --- during which it was made. The metrics are:
+
+    ``query``
+        seconds spent running a query and loading its rows
+    ``rows``
+        the number of rows loaded by a query
+    ``format``
+        seconds spent formatting entities as messages
+    ``cursor_encode``, ``cursor_decode``
+        seconds spent encoding or decoding a page token
+
+    A backend for a metrics system implements :meth:`observe`.
+    """
+
+    def observe(self, metric: str, value: float, resource: str, operation: str) -> None:
+        raise NotImplementedError
+
+    def timer(self, metric: str, resource: str, operation: str) -> 'Timer':
+        return Timer(self, metric, resource, operation)
+
+
+class Timer(object):
+    """
+    A context manager that observes the seconds spent within it.
+    """
+    __slots__ = ('instrumentation', 'metric', 'resource', 'operation', '_start')
+
+    def __init__(self, instrumentation: Instrumentation, metric: str, resource: str, operation: str) -> None:
+        self.instrumentation = instrumentation
+        self.metric = metric
+        self.resource = resource
+        self.operation = operation
+
+    def __enter__(self) -> 'Timer':
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.instrumentation.observe(self.metric, perf_counter() - self._start, self.resource, self.operation)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self) -> '_NullTimer':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+# used in place of a timer when there is no instrumentation, so that uninstrumented resources pay next to nothing
+NULL_TIMER = _NullTimer()
+
+
+class _Histogram(object):
+    __slots__ = ('bounds', 'counts', 'count', 'sum', 'min', 'max')
+
+    def __init__(self, bounds: Sequence[float]) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+
+class HistogramCollector(Instrumentation):
+    """
+    An in-process collector that keeps a histogram of the values of each metric, resource and operation. The
+    histograms can be read with :meth:`histograms` or through an :class:`InstrumentationService`::
+
+        collector = HistogramCollector()
+
+        class PetService(DynamicResourceService):
+            __resource__ = SQLAlchemyResource(Pet, PetMessage)
+
+            class Meta:
+                instrumentation = collector
+
+    Each bucket counts the values up to and including its upper bound that are greater than the bound of the
+    previous bucket; the last bucket has no upper bound.
+    """
+
+    time_buckets: Sequence[float] = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                                     1, 2.5, 5, 10)
+    count_buckets: Sequence[float] = (0, 1, 10, 50, 100, 500, 1000, 5000, 10000)
+
+    # metrics that are counts rather than durations
+    count_metrics = frozenset(['rows'])
+
+    def __init__(self) -> None:
+        self._histograms: Dict[Tuple[str, str, str], _Histogram] = {}
+        self._lock = Lock()
+
+    def observe(self, metric: str, value: float, resource: str, operation: str) -> None:
+        key = (metric, resource, operation)
+
+        with self._lock:
+            try:
+                histogram = self._histograms[key]
+            except KeyError:
+                bounds = self.count_buckets if metric in self.count_metrics else self.time_buckets
+                histogram = self._histograms[key] = _Histogram(bounds)
+            histogram.add(value)
+
+    def histograms(self) -> List[Dict[str, Any]]:
+        """
+        Returns a snapshot of every histogram, ordered by metric, resource and operation.
+        """
+        with self._lock:
+            return [{
+                'metric': metric,
+                'resource': resource,
+                'operation': operation,
+                'count': histogram.count,
+                'sum': histogram.sum,
+                'min': histogram.min,
+                'max': histogram.max,
+                'buckets': list(zip(list(histogram.bounds) + [None], histogram.counts))
+            } for (metric, resource, operation), histogram in sorted(self._histograms.items())]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._histograms.clear()
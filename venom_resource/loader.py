@@ -0,0 +1,75 @@
+import asyncio
+from typing import Any, Dict, List
+
+from flask import g, has_app_context
+from venom.exceptions import NotFound
+
+
+class EntityLoader(object):
+    """
+    Batches the lookups of entities by id for a resource. Every id passed to :meth:`load` within one tick of the event
+    loop is loaded using a single call to :meth:`Resource.get_many`, which runs a single ``IN`` query.
+
+    Loaders are scoped to a request (see :meth:`for_resource`), and so is the session that the entities are loaded
+    into. The identity map of the session memoises the loaded entities, so that later lookups of the same ids with
+    :meth:`Resource.get` or :meth:`Resource.get_many` during the request do not query the database again. If the
+    resource has an executor, the entities are loaded in the session of a worker thread and then merged into the
+    session of the request with :meth:`Resource.attach`, which memoises them in the same way.
+    """
+
+    def __init__(self, resource: 'venom_resource.resource.Resource') -> None:
+        self.resource = resource
+        self._pending: Dict[Any, List[asyncio.Future]] = {}
+
+    @classmethod
+    def for_resource(cls, resource: 'venom_resource.resource.Resource') -> 'EntityLoader':
+        """
+        Returns the loader of the resource for the current request, or a new loader outside of an application
+        context.
+        """
+        if not has_app_context():
+            return cls(resource)
+
+        try:
+            loaders = g._venom_resource_loaders
+        except AttributeError:
+            loaders = g._venom_resource_loaders = {}
+
+        try:
+            return loaders[resource]
+        except KeyError:
+            loaders[resource] = loader = cls(resource)
+            return loader
+
+    async def load(self, id_: Any) -> Any:
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        if not self._pending:
+            loop.call_soon(self._dispatch)
+
+        self._pending.setdefault(id_, []).append(future)
+        return await future
+
+    def _dispatch(self) -> None:
+        pending, self._pending = self._pending, {}
+        asyncio.ensure_future(self._load(pending))
+
+    async def _load(self, pending: Dict[Any, List[asyncio.Future]]) -> None:
+        try:
+            entities = self.resource.attach(await self.resource.run(self.resource.get_many, list(pending)))
+        except Exception as e:
+            for futures in pending.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+
+        for id_, futures in pending.items():
+            for future in futures:
+                if future.done():
+                    continue
+                if id_ in entities:
+                    future.set_result(entities[id_])
+                else:
+                    future.set_exception(NotFound())
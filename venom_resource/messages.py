@@ -3,7 +3,7 @@ from typing import TypeVar
 from venom import Message
 from venom.common import FieldMask
 from venom.common.types import JSONObject, JSONValue
-from venom.fields import String, Integer, Field, RepeatField
+from venom.fields import String, Integer, Field, RepeatField, Bool, Number
 
 E = TypeVar('E')
 
@@ -15,11 +15,70 @@ class ListEntitiesRequest(Message):
     page_token = String()
     page_size = Integer()
 
+    read_mask = Field(FieldMask)
+
+    # One of "exact", "capped" or "estimate"; no total count is returned if empty.
+    count_mode = String()
+
 
 class ListEntitiesResponse(Message):
     next_page_token = String()
     items = RepeatField(Message)
 
+    total_count = Integer()
+    total_count_exact = Bool()
+
 
 class UpdateEntityRequest(Message):
     update_mask = Field(FieldMask)
+
+
+class BatchGetEntitiesRequest(Message):
+    ids = RepeatField(Integer)
+    read_mask = Field(FieldMask)
+
+
+class BatchCreateEntitiesRequest(Message):
+    items = RepeatField(Message)
+
+
+class BatchUpdateEntitiesRequest(Message):
+    items = RepeatField(UpdateEntityRequest)
+
+
+class BatchDeleteEntitiesRequest(Message):
+    ids = RepeatField(Integer)
+
+
+class BatchEntityError(Message):
+    index = Integer()
+    status = Integer()
+    description = String()
+
+
+class BatchEntitiesResponse(Message):
+    items = RepeatField(Message)
+    errors = RepeatField(BatchEntityError)
+
+
+class HistogramBucket(Message):
+    # The last bucket of a histogram has no upper bound.
+    upper_bound = Number()
+    count = Integer()
+
+
+class Histogram(Message):
+    metric = String()
+    resource = String()
+    operation = String()
+
+    count = Integer()
+    sum = Number()
+    min = Number()
+    max = Number()
+
+    buckets = RepeatField(HistogramBucket)
+
+
+class ListHistogramsResponse(Message):
+    histograms = RepeatField(Histogram)
@@ -1,6 +1,9 @@
-from typing import Generic, Type, Dict, Any, Mapping, Union, TypeVar, NamedTuple, List, Tuple
+from hashlib import sha1
+from typing import Generic, Type, Dict, Any, Mapping, Union, TypeVar, NamedTuple, List, Tuple, Sequence, Callable, \
+    Container, Iterator
 from venom.common import FieldMask, Message, Converter, Field
 from venom.common.types import JSONObject, JSONValue
+from venom.exceptions import Error
 from venom.fields import RepeatField
 from venom.message import from_object, message_factory
 from venom.rpc import Service
@@ -8,7 +11,12 @@ from venom.rpc.method import MethodDecorator, HTTPMethodDecorator
 from venom.rpc.resolver import Resolver
 from venom.util import cached_property, upper_camelcase
 
-from .messages import ListEntitiesRequest, ListEntitiesResponse, UpdateEntityRequest
+from .exceptions import NotModified
+from .instrumentation import NULL_TIMER
+from .loader import EntityLoader
+from .messages import ListEntitiesRequest, ListEntitiesResponse, UpdateEntityRequest, BatchCreateEntitiesRequest, \
+    BatchUpdateEntitiesRequest, BatchDeleteEntitiesRequest, BatchEntitiesResponse, BatchEntityError, \
+    BatchGetEntitiesRequest
 from .methods import EntityMethodDescriptor
 
 _Mo = TypeVar('Mo')
@@ -28,6 +36,11 @@ class Relationship(_Relationship):
         return Resource.resolve(self.reference)
 
 
+def _hash(*values: Any) -> str:
+    # NOTE messages have a deterministic representation that contains every value that is set.
+    return sha1(repr(values).encode()).hexdigest()
+
+
 class Resource(Generic[_Mo, _Mo_id, _M]):
     _resources: Dict[str, 'Resource'] = {}
 
@@ -44,6 +57,23 @@ class Resource(Generic[_Mo, _Mo_id, _M]):
     order_schema: Any = None
     filter_schema: Any = None
 
+    # JSON schemas of the filters and order of a list request, included in the options of the fields.
+    filter_json_schema: Any = None
+    order_json_schema: Any = None
+
+    # An executor such as ThreadPoolResourceExecutor that runs blocking database work away from the event loop.
+    executor: Any = None
+
+    # A Cache such as LRUCache in which formatted model messages and their entity tags are looked up by id.
+    cache: Any = None
+
+    # The name of an attribute, such as a version counter, that changes whenever the entity changes. If set, entity
+    # tags are derived from it instead of from the formatted message.
+    version_attribute: str = None
+
+    # An Instrumentation such as HistogramCollector that observes the time spent querying and formatting.
+    instrumentation: Any = None
+
     request_id_field_name: str
     request_path: str
 
@@ -70,29 +100,238 @@ class Resource(Generic[_Mo, _Mo_id, _M]):
             self.name = name
             self._resources[name] = self
 
+    async def run(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        Calls a function that accesses the database, using :attr:`executor` if one is set. Without an executor the
+        function is called directly and blocks the event loop.
+        """
+        if self.executor is None:
+            return func(*args, **kwargs)
+        return await self.executor.run(func, *args, **kwargs)
+
+    def _timer(self, metric: str, operation: str):
+        if self.instrumentation is None:
+            return NULL_TIMER
+        return self.instrumentation.timer(metric, self.model_name, operation)
+
+    def _observe(self, metric: str, value: float, operation: str) -> None:
+        if self.instrumentation is not None:
+            self.instrumentation.observe(metric, value, self.model_name, operation)
+
+    def get_message(self, id_: _Mo_id, if_none_match: Container[str] = ()) -> Tuple[_M, str]:
+        """
+        Returns the formatted model message of the entity with the given id and its entity tag, reading both through
+        :attr:`cache` if one is set.
+
+        :raises NotModified: if the entity tag is in ``if_none_match``. With a :attr:`version_attribute` this is
+            raised before the entity is formatted.
+        """
+        key = self._cache_key(id_)
+        cached = self.cache.get(key) if self.cache is not None else None
+
+        if cached is None:
+            entity = self.get(id_)
+
+            if self.version_attribute:
+                tag = self.entity_tag(entity)
+                if tag in if_none_match:
+                    raise NotModified(tag)
+                with self._timer('format', 'get'):
+                    message = self.format(entity)
+            else:
+                with self._timer('format', 'get'):
+                    message = self.format(entity)
+                tag = self.message_tag(message)
+
+            if self.cache is not None:
+                self.cache.set(key, (message, tag))
+        else:
+            message, tag = cached
+
+        if tag in if_none_match:
+            raise NotModified(tag)
+        return message, tag
+
+    def format_page(self,
+                    entities: Sequence[_Mo],
+                    read_mask: FieldMask = None,
+                    if_none_match: Container[str] = (),
+                    extra: Sequence[Any] = ()) -> Tuple[List[_M], str]:
+        """
+        Formats a page of entities and returns the messages with an entity tag for the page. ``extra`` are any other
+        values of the response that the tag should depend on, such as the next page token.
+
+        :raises NotModified: if the entity tag is in ``if_none_match``. With a :attr:`version_attribute` this is
+            raised before the entities are formatted.
+        """
+        paths = sorted(read_mask.paths) if read_mask is not None else None
+
+        if self.version_attribute:
+            tag = _hash(paths, extra, [self.entity_tag(entity) for entity in entities])
+            if tag in if_none_match:
+                raise NotModified(tag)
+            with self._timer('format', 'list'):
+                return self.format_many(entities, read_mask), tag
+
+        with self._timer('format', 'list'):
+            messages = self.format_many(entities, read_mask)
+        tag = _hash(paths, extra, messages)
+        if tag in if_none_match:
+            raise NotModified(tag)
+        return messages, tag
+
+    def entity_tag(self, entity: _Mo) -> str:
+        return _hash(getattr(entity, self.model_id_attribute), getattr(entity, self.version_attribute))
+
+    def message_tag(self, message: _M) -> str:
+        return _hash(message)
+
+    def _cache_key(self, id_: _Mo_id) -> Tuple[str, str, _Mo_id]:
+        # resources of the same model may format different messages, which are cached separately
+        return self.model_name, self.model_message.__meta__.name, id_
+
+    def invalidate(self, *ids: _Mo_id) -> None:
+        """
+        Removes the messages of the entities with the given ids from :attr:`cache` and from the caches of every other
+        registered resource of the same model.
+        """
+        resources = {self}
+        resources.update(resource for resource in self._resources.values() if resource.model is self.model)
+
+        for resource in resources:
+            if resource.cache is not None:
+                for id_ in ids:
+                    resource.cache.delete(resource._cache_key(id_))
+
     def create(self, properties: Mapping[str, Any]) -> _Mo:
         raise NotImplementedError
 
-    def get(self, id_: _Mo_id, *filters: Any) -> _Mo:
+    def create_message(self, properties: Mapping[str, Any]) -> _M:
+        """
+        Creates an entity and returns its formatted model message.
+        """
+        return self.format(self.create(properties))
+
+    def get(self, id_: _Mo_id, *filters: Any, read_mask: FieldMask = None) -> _Mo:
+        raise NotImplementedError
+
+    def get_many(self, ids: Sequence[_Mo_id], read_mask: FieldMask = None) -> Dict[_Mo_id, _Mo]:
         raise NotImplementedError
 
+    def attach(self, entities: Dict[_Mo_id, _Mo]) -> Dict[_Mo_id, _Mo]:
+        """
+        Returns entities that were loaded through :meth:`run` in a form that the caller can change and write. Entities
+        loaded by an :attr:`executor` may belong to the session of a worker thread.
+        """
+        return entities
+
+    @property
+    def entity_loader(self) -> EntityLoader:
+        return EntityLoader.for_resource(self)
+
     def update(self, entity: _Mo, changes: Mapping[str, Any], mask: FieldMask) -> _Mo:
         raise NotImplementedError
 
+    def update_by_id(self, id_: _Mo_id, changes: Mapping[str, Any], mask: FieldMask) -> _M:
+        """
+        Updates the entity with the given id and returns its formatted model message.
+        """
+        return self.format(self.update(self.get(id_), changes, mask))
+
     def paginate(self,
+                 page_size: int = None,
                  page_token: str = '',
-                 page_size: int = 0,
-                 *filters: Any) -> Tuple[List[_M], str]:
+                 ordering: Any = None,
+                 filters: List[Any] = None,
+                 read_mask: FieldMask = None,
+                 count_mode: str = None) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def export(self, filters: List[Any] = None, read_mask: FieldMask = None) -> Iterator[List[_M]]:
+        raise NotImplementedError
+
+    def parse_ordering(self, order: Sequence[Any]) -> Any:
+        raise NotImplementedError
+
+    def parse_filters(self, filters: Mapping[str, Any]) -> List[Any]:
         raise NotImplementedError
 
     def delete(self, entity: _Mo) -> None:
         raise NotImplementedError
 
+    def delete_by_id(self, id_: _Mo_id) -> None:
+        self.delete(self.get(id_))
+
+    def batch_get(self, ids: Sequence[_Mo_id], read_mask: FieldMask = None) -> List[Union[_Mo, Error]]:
+        raise NotImplementedError
+
+    def batch_create(self, properties: Sequence[Mapping[str, Any]]) -> List[Union[_Mo, Error]]:
+        raise NotImplementedError
+
+    def batch_create_messages(self, properties: Sequence[Mapping[str, Any]]) -> List[Union[_M, Error]]:
+        """
+        Creates an entity for each item of ``properties`` and returns either its formatted model message or the error
+        raised for each item.
+        """
+        return self.format_results(self.batch_create(properties))
+
+    def batch_update(self, changes: Sequence[Tuple[_Mo_id, Mapping[str, Any], FieldMask]]) -> List[Union[_Mo, Error]]:
+        raise NotImplementedError
+
+    def batch_update_messages(self,
+                              changes: Sequence[Tuple[_Mo_id, Mapping[str, Any], FieldMask]]) -> List[Union[_M, Error]]:
+        """
+        Applies a list of ``(id, changes, mask)`` updates and returns either the formatted model message of the
+        updated entity or the error raised for each update.
+        """
+        return self.format_results(self.batch_update(changes))
+
+    def batch_delete(self, ids: Sequence[_Mo_id]) -> List[Union[None, Error]]:
+        raise NotImplementedError
+
+    def format(self, entity: _Mo) -> _M:
+        raise NotImplementedError
+
+    def format_many(self, entities: Sequence[_Mo], read_mask: FieldMask = None) -> List[_M]:
+        return [self.format(entity) for entity in entities]
+
+    def format_batch(self,
+                     results: Sequence[Union[_Mo, Error, None]],
+                     read_mask: FieldMask = None) -> BatchEntitiesResponse:
+        """
+        Formats the results of a batch operation, where each result is an entity, an error or ``None``, as a batch
+        response. The errors refer to the items of the request by their index.
+        """
+        return self.batch_response(self.format_results(results, read_mask))
+
+    def format_results(self,
+                       results: Sequence[Union[_Mo, Error, None]],
+                       read_mask: FieldMask = None) -> List[Union[_M, Error, None]]:
+        """
+        Formats the entities among the results of a batch operation using :meth:`format_many`, keeping the errors and
+        ``None`` results in place.
+        """
+        indices = [index for index, result in enumerate(results)
+                   if result is not None and not isinstance(result, Error)]
+        formatted = list(results)
+        for index, message in zip(indices, self.format_many([results[index] for index in indices], read_mask)):
+            formatted[index] = message
+        return formatted
+
+    def batch_response(self, results: Sequence[Union[_M, Error, None]]) -> BatchEntitiesResponse:
+        """
+        Returns the batch response for formatted results, where each result is a model message, an error or ``None``.
+        """
+        messages = [result for result in results if result is not None and not isinstance(result, Error)]
+        errors = [BatchEntityError(index=index, status=result.http_status, description=result.description)
+                  for index, result in enumerate(results) if isinstance(result, Error)]
+        return self.batch_response_message(messages, errors)
+
     @cached_property
     def list_request_message(self) -> Type[ListEntitiesRequest]:
         return message_factory(f'List{upper_camelcase(self.name)}Request', {
-            'filters': Field(JSONObject, schema=self.filter_schema),
-            'order': RepeatField(JSONValue, schema=self.order_schema)
+            'filters': Field(JSONObject, schema=self.filter_schema, json_schema=self.filter_json_schema),
+            'order': RepeatField(JSONValue, schema=self.order_schema, options={'json_schema': self.order_json_schema})
         }, super_message=ListEntitiesRequest)
 
     @cached_property
@@ -108,6 +347,36 @@ class Resource(Generic[_Mo, _Mo_id, _M]):
             self.model_name: Field(self.model_message)
         }, super_message=UpdateEntityRequest)
 
+    @cached_property
+    def batch_get_request_message(self) -> Type[BatchGetEntitiesRequest]:
+        return message_factory(f'BatchGet{upper_camelcase(self.name)}Request', {
+            'ids': RepeatField(self.model_id_type)
+        }, super_message=BatchGetEntitiesRequest)
+
+    @cached_property
+    def batch_create_request_message(self) -> Type[BatchCreateEntitiesRequest]:
+        return message_factory(f'BatchCreate{upper_camelcase(self.name)}Request', {
+            'items': RepeatField(self.model_message)
+        }, super_message=BatchCreateEntitiesRequest)
+
+    @cached_property
+    def batch_update_request_message(self) -> Type[BatchUpdateEntitiesRequest]:
+        return message_factory(f'BatchUpdate{upper_camelcase(self.name)}Request', {
+            'items': RepeatField(self.update_request_message)
+        }, super_message=BatchUpdateEntitiesRequest)
+
+    @cached_property
+    def batch_delete_request_message(self) -> Type[BatchDeleteEntitiesRequest]:
+        return message_factory(f'BatchDelete{upper_camelcase(self.name)}Request', {
+            'ids': RepeatField(self.model_id_type)
+        }, super_message=BatchDeleteEntitiesRequest)
+
+    @cached_property
+    def batch_response_message(self) -> Type[BatchEntitiesResponse]:
+        return message_factory(f'Batch{upper_camelcase(self.name)}Response', {
+            'items': RepeatField(self.model_message)
+        }, super_message=BatchEntitiesResponse)
+
     @cached_property
     def get_request_message(self) -> Type[Message]:
         return message_factory(f'Get{upper_camelcase(self.name)}Request', {
@@ -187,7 +456,7 @@ class ResourceEntityResolver(Resolver):
         return self.resource.model
 
     async def resolve(self, service: Service, request: Message) -> Any:
-        return self.resource.get_from_message(request)
+        return await self.resource.entity_loader.load(request[self.resource.request_id_field_name])
 
 
 class ResourceEntityIDConverter(ResourceConverterBase, Converter):
@@ -202,6 +471,8 @@ class ResourceEntityIDConverter(ResourceConverterBase, Converter):
         return self.resource.model
 
     def resolve(self, id_: Any) -> Any:
+        # NOTE converters are resolved synchronously, so lookups cannot be batched here. Entities that have been
+        # loaded already during the request, such as with get_many(), are returned from the identity map.
         return self.resource.get(id_)
 
     def format(self, entity: Any) -> Any:
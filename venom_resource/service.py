@@ -1,20 +1,67 @@
 from operator import attrgetter
-from typing import ClassVar, Any
+from typing import ClassVar, Any, Container, Mapping
 
+import flask
 from venom import Message, Empty
+from venom.common import FieldMask
+from venom.protocol import JSONProtocol
 from venom.rpc import Service, http
 from venom.rpc.inspection import dynamic
 
 from venom_resource import SQLAlchemyResource
+from .exceptions import NotModified
+from .instrumentation import HistogramCollector
+from .messages import ListHistogramsResponse, Histogram, HistogramBucket
 from .resource import Resource
 
 
+class _IfNoneMatch(Container[str]):
+    """
+    The entity tags of an ``If-None-Match`` header, including ``*``. Tags are matched with the weak comparison of
+    RFC 7232, so that ``W/"tag"`` matches ``"tag"``.
+    """
+
+    def __init__(self, etags: 'werkzeug.datastructures.ETags') -> None:
+        self.etags = etags
+
+    def __contains__(self, tag: Any) -> bool:
+        return self.etags.contains_weak(tag)
+
+
+def _if_none_match() -> Container[str]:
+    # only safe methods are answered with 304 Not Modified; other methods ignore the header
+    if flask.has_request_context() and flask.request.method in ('GET', 'HEAD'):
+        return _IfNoneMatch(flask.request.if_none_match)
+    return ()
+
+
+def _set_etag(tag: str) -> None:
+    # NOTE the response is only available after the view returns, and after_this_request() must be called from the
+    # request context of the view rather than from a worker thread of the executor.
+    if flask.has_request_context():
+        def set_etag(response):
+            response.set_etag(tag)
+            return response
+
+        flask.after_this_request(set_etag)
+
+
 class ResourceService(Service):
     __resources__: ClassVar[SQLAlchemyResource] = set()
 
     class Meta:
         default_page_size: int = None
         maximum_page_size: int = 100
+        keyset_pagination: bool = False
+        allow_unindexed_ordering: bool = False
+        cursor_secret_key: bytes = None
+        executor: Any = None
+        count_cap: int = None
+        count_cache_ttl: float = None
+        cache: Any = None
+        version_attribute: str = None
+        instrumentation: Any = None
+        foreign_key_check: str = None
 
 
 class DynamicResourceService(ResourceService):
@@ -28,42 +75,183 @@ class DynamicResourceService(ResourceService):
                http_status=201,
                auto=True)
     @dynamic('request', attrgetter('__resource__.model_message'))
-    @dynamic('return', attrgetter('__resource__.model'))
-    def create(self, request: Any) -> Any:
-        return self.__resource__.create(request)
+    @dynamic('return', attrgetter('__resource__.model_message'))
+    async def create(self, request: Any) -> Any:
+        return await self.__resource__.run(self.__resource__.create_message, request)
 
     @http.GET(attrgetter('__resource__.request_path'),
               name=lambda owner: f'get_{owner.__resource__.model_name}',
               auto=True)
     @dynamic('request', attrgetter('__resource__.get_request_message'))
-    @dynamic('return', attrgetter('__resource__.model'))
-    def get(self, request: Message) -> Any:
-        return self.__resource__.get(request.get(self.__resource__.request_id_field_name))
+    @dynamic('return', attrgetter('__resource__.model_message'))
+    async def get(self, request: Message) -> Any:
+        try:
+            message, tag = await self.__resource__.run(self.__resource__.get_message,
+                                                       request.get(self.__resource__.request_id_field_name),
+                                                       _if_none_match())
+        except NotModified as e:
+            _set_etag(e.tag)
+            raise
+
+        _set_etag(tag)
+        return message
 
     @http.POST('.',
                name=lambda owner: f'list_{owner.__resource__.model_plural_name}',
                auto=True)
     @dynamic('request', attrgetter('__resource__.list_request_message'))
     @dynamic('return', attrgetter('__resource__.list_response_message'))
-    def list(self, request: Any) -> Any:
-        result = self.__resource__.paginate()
-        return self.__resource__.list_response_message(result['next_page_token'],
-                                                       [self.__resource__.format(item) for item in result['items']])
+    async def list(self, request: Any) -> Any:
+        read_mask = request.read_mask if 'read_mask' in request else None
+        if_none_match = _if_none_match()
+
+        def list_():
+            result = self.__resource__.paginate(page_size=request.page_size,
+                                                page_token=request.page_token,
+                                                ordering=self.__resource__.parse_ordering(request.order),
+                                                filters=self.__resource__.parse_filters(request.get('filters', {})),
+                                                read_mask=read_mask,
+                                                count_mode=request.count_mode)
+
+            extra = (result['next_page_token'], result.get('total_count'), result.get('total_count_exact'))
+            messages, tag = self.__resource__.format_page(result['items'], read_mask, if_none_match, extra)
+            return self.__resource__.list_response_message(result['next_page_token'],
+                                                           messages,
+                                                           total_count=result.get('total_count'),
+                                                           total_count_exact=result.get('total_count_exact')), tag
+
+        try:
+            response, tag = await self.__resource__.run(list_)
+        except NotModified as e:
+            _set_etag(e.tag)
+            raise
+
+        _set_etag(tag)
+        return response
+
+    def export(self, filters: Mapping[str, Any] = None, read_mask: FieldMask = None) -> flask.Response:
+        """
+        Returns a response that streams every entity matching ``filters`` as newline-delimited JSON.
+
+        Methods of a venom service cannot stream their response, so this is not an RPC and needs to be added as a view
+        of the application::
+
+            @app.route('/pet/export', methods=['POST'])
+            def export_pets():
+                return venom.get_instance(PetService).export(flask.request.get_json(silent=True))
+
+        """
+        resource = self.__resource__
+        filters = resource.parse_filters(filters or {})
+        protocol = JSONProtocol(resource.model_message)
+
+        def generate():
+            for messages in resource.export(filters, read_mask):
+                yield b''.join(protocol.pack(message) + b'\n' for message in messages)
+
+        return flask.Response(flask.stream_with_context(generate()), mimetype='application/x-ndjson')
 
     @http.PATCH(attrgetter('__resource__.request_path'),
                 name=lambda owner: f'update_{owner.__resource__.model_name}',
                 auto=True)
     @dynamic('request', attrgetter('__resource__.update_request_message'))
-    @dynamic('return', attrgetter('__resource__.model'))
-    def update(self, request: Any) -> Any:
-        entity = self.__resource__.get(request.get(self.__resource__.request_id_field_name))
-        return self.__resource__.update(entity, request.get(self.__resource__.model_name), request.update_mask)
+    @dynamic('return', attrgetter('__resource__.model_message'))
+    async def update(self, request: Any) -> Any:
+        return await self.__resource__.run(self.__resource__.update_by_id,
+                                           request.get(self.__resource__.request_id_field_name),
+                                           request.get(self.__resource__.model_name),
+                                           request.update_mask)
 
     @http.DELETE(attrgetter('__resource__.request_path'),
                  name=lambda owner: f'delete_{owner.__resource__.model_name}',
                  http_status=204,
                  auto=True)
     @dynamic('request', attrgetter('__resource__.get_request_message'))
-    def delete(self, request: Message) -> None:
-        entity = self.__resource__.get(request.get(self.__resource__.request_id_field_name))
-        self.__resource__.delete(entity)
+    async def delete(self, request: Message) -> None:
+        await self.__resource__.run(self.__resource__.delete_by_id,
+                                    request.get(self.__resource__.request_id_field_name))
+
+    @http.POST('./batch_get',
+               name=lambda owner: f'batch_get_{owner.__resource__.model_plural_name}',
+               auto=True)
+    @dynamic('request', attrgetter('__resource__.batch_get_request_message'))
+    @dynamic('return', attrgetter('__resource__.batch_response_message'))
+    async def batch_get(self, request: Any) -> Any:
+        read_mask = request.read_mask if 'read_mask' in request else None
+
+        def batch_get():
+            return self.__resource__.format_batch(self.__resource__.batch_get(request.ids, read_mask), read_mask)
+
+        return await self.__resource__.run(batch_get)
+
+    @http.POST('./batch_create',
+               name=lambda owner: f'batch_create_{owner.__resource__.model_plural_name}',
+               auto=True)
+    @dynamic('request', attrgetter('__resource__.batch_create_request_message'))
+    @dynamic('return', attrgetter('__resource__.batch_response_message'))
+    async def batch_create(self, request: Any) -> Any:
+        def batch_create():
+            return self.__resource__.batch_response(self.__resource__.batch_create_messages(request.items))
+
+        return await self.__resource__.run(batch_create)
+
+    @http.POST('./batch_update',
+               name=lambda owner: f'batch_update_{owner.__resource__.model_plural_name}',
+               auto=True)
+    @dynamic('request', attrgetter('__resource__.batch_update_request_message'))
+    @dynamic('return', attrgetter('__resource__.batch_response_message'))
+    async def batch_update(self, request: Any) -> Any:
+        changes = [(item.get(self.__resource__.request_id_field_name),
+                    item.get(self.__resource__.model_name),
+                    item.update_mask) for item in request.items]
+
+        def batch_update():
+            return self.__resource__.batch_response(self.__resource__.batch_update_messages(changes))
+
+        return await self.__resource__.run(batch_update)
+
+    @http.POST('./batch_delete',
+               name=lambda owner: f'batch_delete_{owner.__resource__.model_plural_name}',
+               auto=True)
+    @dynamic('request', attrgetter('__resource__.batch_delete_request_message'))
+    @dynamic('return', attrgetter('__resource__.batch_response_message'))
+    async def batch_delete(self, request: Any) -> Any:
+        def batch_delete():
+            return self.__resource__.format_batch(self.__resource__.batch_delete(request.ids))
+
+        return await self.__resource__.run(batch_delete)
+
+
+class InstrumentationService(Service):
+    """
+    Reports the histograms of a :class:`HistogramCollector`, which is set in the ``Meta`` of a subclass::
+
+        collector = HistogramCollector()
+
+        class MetricsService(InstrumentationService):
+            class Meta:
+                instrumentation = collector
+
+    """
+
+    class Meta:
+        instrumentation: HistogramCollector = None
+
+    @http.GET('./histograms')
+    def list_histograms(self) -> ListHistogramsResponse:
+        collector = self.__meta__.instrumentation
+        if collector is None:
+            return ListHistogramsResponse([])
+
+        return ListHistogramsResponse([
+            Histogram(metric=histogram['metric'],
+                      resource=histogram['resource'],
+                      operation=histogram['operation'],
+                      count=histogram['count'],
+                      sum=histogram['sum'],
+                      min=histogram['min'],
+                      max=histogram['max'],
+                      buckets=[HistogramBucket(upper_bound=upper_bound, count=count)
+                               for upper_bound, count in histogram['buckets']])
+            for histogram in collector.histograms()
+        ])